@@ -0,0 +1,129 @@
+"""
+Benchmark the conversion of entity csv rows to age formatted properties.
+
+Compares RowConverter on csv.reader rows with create_properties followed by
+age_format_properties on csv.DictReader rows, the conversion used before RowConverter.
+Both are first checked to produce the same properties for every type in PARSERS.
+
+    poetry run python -m benchmarks.row_converter --rows 50000
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import time
+import typing
+
+from triplehop_import_tools import db_data
+
+# Example values per type in the import config, None is written as an empty cell
+VALUES: typing.Dict[str, typing.List[typing.Optional[str]]] = {
+    "int": ["1", "42", "-7", "123456789", None],
+    "string": ["Ghent", "a, b", 'quoted "value"', "ü", None],
+    "edtf": ["1985-04-12", "1984?", "2004-06/2006-08", "1964/2008", None],
+    "[string]": ["a|b|c", "single", "x|", "|", None],
+    "geometry": [
+        json.dumps({"type": "Point", "coordinates": [3.72, 51.05]}),
+        json.dumps({"type": "LineString", "coordinates": [[0, 0], [1, 1.5]]}),
+        None,
+    ],
+}
+
+
+def create_config(
+    columns: int,
+) -> typing.Tuple[typing.List[str], typing.Dict, typing.Dict]:
+    """Create the csv header, field lookup and prop config, cycling through PARSERS."""
+    types = list(db_data.PARSERS)
+    fieldnames = ["id"]
+    db_props_lookup = {}
+    prop_conf = {"id": ["int", "id"]}
+    for i in range(columns - 1):
+        type = types[i % len(types)]
+        fieldnames.append(f"column_{i}")
+        db_props_lookup[f"prop_{i}"] = f"00000000-0000-0000-0000-{i:012d}"
+        prop_conf[f"prop_{i}"] = [type, f"column_{i}"]
+        if type == "[string]":
+            prop_conf[f"prop_{i}"].append("|")
+    return (fieldnames, db_props_lookup, prop_conf)
+
+
+def create_data(fieldnames: typing.List[str], prop_conf: typing.Dict, rows: int) -> str:
+    types = {conf[1]: conf[0] for conf in prop_conf.values()}
+    rng = random.Random(0)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fieldnames)
+    for i in range(rows):
+        row = [str(i + 1)]
+        for fieldname in fieldnames[1:]:
+            value = rng.choice(VALUES[types[fieldname]])
+            row.append("" if value is None else value)
+        writer.writerow(row)
+    return buffer.getvalue()
+
+
+def convert_properties(
+    data: str, db_props_lookup: typing.Dict, prop_conf: typing.Dict
+) -> typing.List[typing.Dict]:
+    return [
+        db_data.age_format_properties(
+            db_data.create_properties(row, db_props_lookup, prop_conf)
+        )[1]
+        for row in csv.DictReader(io.StringIO(data))
+    ]
+
+
+def convert_rows(
+    data: str, db_props_lookup: typing.Dict, prop_conf: typing.Dict
+) -> typing.List[typing.Dict]:
+    reader = csv.reader(io.StringIO(data))
+    converter = db_data.RowConverter(next(reader), db_props_lookup, prop_conf)
+    return [converter(row) for row in reader]
+
+
+def check(data: str, db_props_lookup: typing.Dict, prop_conf: typing.Dict) -> None:
+    expected = convert_properties(data, db_props_lookup, prop_conf)
+    result = convert_rows(data, db_props_lookup, prop_conf)
+    if result != expected:
+        for (i, (a, b)) in enumerate(zip(result, expected)):
+            if a != b:
+                raise Exception(f"Row {i + 1} differs: {a} != {b}")
+        raise Exception("Number of rows differs")
+
+
+def measure(method: typing.Callable, repeat: int, *args) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        method(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    (fieldnames, db_props_lookup, prop_conf) = create_config(args.columns)
+    data = create_data(fieldnames, prop_conf, args.rows)
+    check(data, db_props_lookup, prop_conf)
+    print(f"Output identical for types: {', '.join(db_data.PARSERS)}")
+
+    baseline = measure(
+        convert_properties, args.repeat, data, db_props_lookup, prop_conf
+    )
+    converter = measure(convert_rows, args.repeat, data, db_props_lookup, prop_conf)
+    print(
+        f"{args.rows} rows, {args.columns} columns (best of {args.repeat}):\n"
+        f"  DictReader + create_properties + age_format_properties: {baseline:.3f}s\n"
+        f"  csv.reader + RowConverter: {converter:.3f}s ({converter / baseline:.0%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from triplehop_import_tools import db_data
+
+
+class FakeTransaction:
+    """
+    Transaction that holds the lock of a count row from the first update of a count
+    table until the end of the transaction, like a row lock in the database.
+    """
+
+    def __init__(self, count_lock: asyncio.Lock, statements: list):
+        self.count_lock = count_lock
+        self.statements = statements
+        self.holds_lock = False
+
+    async def execute(self, query_template, params=None):
+        if "_count" in query_template and not self.holds_lock:
+            await self.count_lock.acquire()
+            self.holds_lock = True
+        self.statements.append(query_template)
+
+    def end(self):
+        if self.holds_lock:
+            self.count_lock.release()
+
+
+class OutOfOrderWritersTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.count_lock = asyncio.Lock()
+        self.statements = []
+
+        async def transaction(pool, work, age=False):
+            tx = FakeTransaction(self.count_lock, self.statements)
+            try:
+                return await work(tx)
+            finally:
+                tx.end()
+
+        async def insert_vertices(*args, **kwargs):
+            # Give the other writer the chance to run
+            await asyncio.sleep(0)
+            return {}
+
+        patches = [
+            mock.patch.object(db_data.db_base, "transaction", transaction),
+            mock.patch.object(db_data, "insert_vertices", insert_vertices),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def entity_job(self, checkpoint_batch: db_data.CheckpointBatch, max_id: int):
+        transformed = asyncio.get_event_loop().create_future()
+        transformed.set_result(([], max_id))
+        return {
+            "pool": None,
+            "project_id": "project",
+            "entity_type_id": "entity-type",
+            "has_id": True,
+            "transformed": transformed,
+            "write_stats": None,
+            "vertex_write_method": "copy",
+            "index": None,
+            "index_table": False,
+            "checkpoint": checkpoint_batch,
+        }
+
+    async def test_later_batch_written_first(self):
+        checkpoint = db_data.Checkpoint("job", "running", 0)
+        first = checkpoint.batch(10)
+        second = checkpoint.batch(20)
+
+        async def write(job):
+            await db_data.write_entities(job)
+            job["checkpoint"].commit()
+
+        # The second batch starts writing before the first one
+        second_write = asyncio.ensure_future(write(self.entity_job(second, 20)))
+        await asyncio.sleep(0)
+        first_write = asyncio.ensure_future(write(self.entity_job(first, 10)))
+        await asyncio.wait_for(asyncio.gather(first_write, second_write), timeout=1)
+
+        self.assertEqual(checkpoint.counter, 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+
+from triplehop_import_tools import lookup_tables
+
+
+class BuildLookupTest(unittest.TestCase):
+    def test_int_lookup_matches_dict(self):
+        pairs = [(3, "30"), (1, "10"), (3, "31"), (2, "20"), (1, "11")]
+        lookup = lookup_tables.build_lookup(iter(pairs))
+        self.assertIsInstance(lookup, lookup_tables.IntLookup)
+        self.assertEqual(dict(lookup), dict(pairs))
+
+    def test_dict_fallback_keeps_all_pairs(self):
+        pairs = [(1, "10"), (2, "20"), ("a", "30"), (1, "11")]
+        lookup = lookup_tables.build_lookup(iter(pairs))
+        self.assertEqual(lookup, dict(pairs))
+
+    def test_from_pairs_keeps_last_value(self):
+        lookup = lookup_tables.IntLookup.from_pairs([(5, 1), (4, 2), (5, 3)])
+        self.assertEqual(dict(lookup), {4: "2", 5: "3"})
+        self.assertNotIn(6, lookup)
@@ -0,0 +1,43 @@
+import csv
+import os
+import tempfile
+import unittest
+
+from triplehop_import_tools import db_data
+
+
+class RejectionSinkTest(unittest.TestCase):
+    def test_row_written_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "rejected", "relations.csv")
+            with db_data.RejectionSink("Relation", filename) as rejections:
+                rejections.reject_row(
+                    {"domain": "1", "range": "2|3"},
+                    [
+                        rejections.reject("person", "id", 1),
+                        rejections.reject("place", "id", 2),
+                        rejections.reject("place", "id", 3),
+                    ],
+                )
+            with open(filename, newline="") as f:
+                rows = list(csv.reader(f))
+        self.assertEqual(
+            rows,
+            [
+                ["rejected", "domain", "range"],
+                ["person id 1; place id 2; place id 3", "1", "2|3"],
+            ],
+        )
+        self.assertEqual(rejections.counts[("place", "id")], 2)
+
+    def test_write_error_is_raised(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # A directory can't be opened as the rejected rows file
+            rejections = db_data.RejectionSink("Relation", directory, max_queued=1)
+            with self.assertRaises(Exception):
+                with rejections:
+                    for i in range(10):
+                        rejections.reject_row(
+                            {"id": i}, [rejections.reject("person", "id", i)]
+                        )
+        self.assertEqual(rejections.counts[("person", "id")], 10)
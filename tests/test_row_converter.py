@@ -0,0 +1,39 @@
+import json
+import unittest
+
+from triplehop_import_tools import db_data
+
+
+class RowConverterTest(unittest.TestCase):
+    def test_same_output_as_create_properties(self):
+        fieldnames = ["id", "name", "date", "tags", "location"]
+        db_props_lookup = {
+            "name": "0000-name",
+            "date": "0000-date",
+            "tags": "0000-tags",
+            "location": "0000-location",
+        }
+        prop_conf = {
+            "id": ["int", "id"],
+            "name": ["string", "name"],
+            "date": ["edtf", "date"],
+            "tags": ["[string]", "tags", "|"],
+            "location": ["geometry", "location"],
+        }
+        # Every type in PARSERS is covered
+        self.assertEqual({conf[0] for conf in prop_conf.values()}, set(db_data.PARSERS))
+        point = json.dumps({"type": "Point", "coordinates": [3.72, 51.05]})
+        rows = [
+            ["1", "Ghent", "1985-04-12", "a|b", point],
+            ["2", "", "", "", ""],
+            ["3", "x"],
+        ]
+        converter = db_data.RowConverter(fieldnames, db_props_lookup, prop_conf)
+        for row in rows:
+            padded = [*row, *[""] * (len(fieldnames) - len(row))]
+            expected = db_data.age_format_properties(
+                db_data.create_properties(
+                    dict(zip(fieldnames, padded)), db_props_lookup, prop_conf
+                )
+            )[1]
+            self.assertEqual(converter(row), expected)
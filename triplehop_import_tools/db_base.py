@@ -1,9 +1,24 @@
+import asyncio
+import csv
+import functools
+import io
+import operator
 import typing
 
 import asyncpg
 import buildpg
 
 RENDERER = buildpg.main.Renderer(regex=r"(?<![a-z\\:]):([a-z][a-z0-9_]*)", sep="__")
+# Errors after which a transaction can be retried as a whole
+RETRY_ERRORS = (
+    asyncpg.exceptions.TransactionRollbackError,
+    asyncpg.exceptions.PostgresConnectionError,
+    ConnectionError,
+)
+RETRIES = 3
+RETRY_DELAY = 0.5
+# Number of rendered query templates to keep
+RENDER_CACHE_SIZE = 1024
 
 
 def dtu(string: str) -> str:
@@ -11,13 +26,41 @@ def dtu(string: str) -> str:
     return string.replace("-", "_")
 
 
+@functools.lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _compile(
+    query_template: str,
+    param_names: typing.Tuple[str, ...],
+) -> typing.Tuple[str, typing.Callable[[typing.Dict], typing.Tuple]]:
+    """
+    Render a query template once for a set of parameter names.
+    Returns the final query and a function that extracts the ordered query arguments
+    from a parameter dict. Parameter values are always passed as query arguments, so
+    buildpg components are not supported.
+    """
+    query, names = RENDERER(query_template, **{name: name for name in param_names})
+    query = query.replace("\\:", ":")
+    if not names:
+        return (query, lambda params: ())
+    if len(names) == 1:
+        getter = operator.itemgetter(names[0])
+        return (query, lambda params: (getter(params),))
+    return (query, operator.itemgetter(*names))
+
+
 def _render(query_template: str, params: typing.Dict[str, typing.Any] = None):
     if params is None:
-        query, args = RENDERER(query_template)
-    else:
-        query, args = RENDERER(query_template, **params)
-    query = query.replace("\\:", ":")
-    return [query, args]
+        params = {}
+    query, extract = _compile(query_template, tuple(params))
+    return [query, list(extract(params))]
+
+
+def _render_many(
+    query_template: str,
+    params: typing.List[typing.Dict[str, typing.Any]],
+):
+    """Render a query template for a list of parameter dicts that share the same keys."""
+    query, extract = _compile(query_template, tuple(params[0]))
+    return [query, [extract(p) for p in params]]
 
 
 async def _init_age(conn: asyncpg.connection.Connection):
@@ -26,6 +69,10 @@ async def _init_age(conn: asyncpg.connection.Connection):
             SET search_path = ag_catalog, "$user", public;
         """
     )
+    await _load_age(conn)
+
+
+async def _load_age(conn: asyncpg.connection.Connection):
     await conn.execute(
         """
             LOAD '$libdir/plugins/age';
@@ -33,6 +80,54 @@ async def _init_age(conn: asyncpg.connection.Connection):
     )
 
 
+# Pools created with age=True, on which AGE is initialised when a connection is opened.
+# Pooled connections are proxies that pass isinstance checks for any connection class,
+# so the pool itself is marked instead of the connection. Pools use __slots__ and can't
+# be weakly referenced, so they are kept here until they are closed with close_pool.
+_AGE_POOLS: typing.Set[asyncpg.pool.Pool] = set()
+
+
+def _requires_age_init(pool: asyncpg.pool.Pool, age: bool) -> bool:
+    return age and pool not in _AGE_POOLS
+
+
+async def create_pool(age: bool = False, **kwargs) -> asyncpg.pool.Pool:
+    """
+    Create a connection pool.
+    With age, AGE is initialised once per physical connection instead of on every call
+    with age=True: the search path is passed as a server setting, so it survives the reset
+    when a connection is released, and the AGE library is loaded when the connection is
+    opened. Statements that don't use AGE can still be run on such a pool, as long as
+    they use schema qualified names. Close the pool with close_pool.
+    """
+    if not age:
+        return await asyncpg.create_pool(**kwargs)
+    server_settings = {
+        **kwargs.pop("server_settings", {}),
+        "search_path": 'ag_catalog, "$user", public',
+    }
+    user_init = kwargs.pop("init", None)
+
+    async def init(conn: asyncpg.connection.Connection):
+        await _load_age(conn)
+        if user_init is not None:
+            await user_init(conn)
+
+    pool = await asyncpg.create_pool(
+        server_settings=server_settings,
+        init=init,
+        **kwargs,
+    )
+    _AGE_POOLS.add(pool)
+    return pool
+
+
+async def close_pool(pool: asyncpg.pool.Pool) -> None:
+    """Close a pool created with create_pool."""
+    _AGE_POOLS.discard(pool)
+    await pool.close()
+
+
 async def execute(
     pool: asyncpg.pool.Pool,
     query_template,
@@ -41,7 +136,7 @@ async def execute(
 ):
     async with pool.acquire() as conn:
         query, args = _render(query_template, params)
-        if age:
+        if _requires_age_init(pool, age):
             async with conn.transaction():
                 await _init_age(conn)
                 return await conn.execute(query, *args)
@@ -55,9 +150,8 @@ async def executemany(
     age: bool = False,
 ):
     async with pool.acquire() as conn:
-        query, _ = _render(query_template, params[0])
-        args = [_render(query_template, p)[1] for p in params]
-        if age:
+        query, args = _render_many(query_template, params)
+        if _requires_age_init(pool, age):
             async with conn.transaction():
                 await _init_age(conn)
                 return await conn.executemany(query, args)
@@ -72,7 +166,7 @@ async def fetch(
 ):
     async with pool.acquire() as conn:
         query, args = _render(query_template, params)
-        if age:
+        if _requires_age_init(pool, age):
             async with conn.transaction():
                 await _init_age(conn)
                 return await conn.fetch(query, *args)
@@ -87,8 +181,141 @@ async def fetchval(
 ):
     async with pool.acquire() as conn:
         query, args = _render(query_template, params)
-        if age:
+        if _requires_age_init(pool, age):
             async with conn.transaction():
                 await _init_age(conn)
                 return await conn.fetchval(query, *args)
         return await conn.fetchval(query, *args)
+
+
+def _csv_encode(records: typing.Iterable[typing.Sequence]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(records)
+    return buffer.getvalue().encode()
+
+
+async def copy_records(
+    pool: asyncpg.pool.Pool,
+    schema_name: str,
+    table_name: str,
+    columns: typing.List[str],
+    records: typing.Iterable[typing.Sequence],
+    age: bool = False,
+):
+    """
+    Bulk load records into a table using COPY.
+    The records are sent in csv format, so every column is parsed with the text input
+    function of its type (e.g., graphid or agtype).
+    """
+    source = io.BytesIO(_csv_encode(records))
+    async with pool.acquire() as conn:
+        if _requires_age_init(pool, age):
+            async with conn.transaction():
+                await _init_age(conn)
+                return await conn.copy_to_table(
+                    table_name,
+                    source=source,
+                    columns=columns,
+                    schema_name=schema_name,
+                    format="csv",
+                )
+        return await conn.copy_to_table(
+            table_name,
+            source=source,
+            columns=columns,
+            schema_name=schema_name,
+            format="csv",
+        )
+
+
+class Transaction:
+    """
+    Query helpers bound to a single connection with an open transaction.
+    The methods take the same query templates and parameters as the module level helpers.
+    """
+
+    def __init__(self, conn: asyncpg.connection.Connection):
+        self.conn = conn
+
+    async def execute(
+        self,
+        query_template,
+        params: typing.Dict[str, typing.Any] = None,
+    ):
+        query, args = _render(query_template, params)
+        return await self.conn.execute(query, *args)
+
+    async def executemany(
+        self,
+        query_template,
+        params: typing.List[typing.Dict[str, typing.Any]],
+    ):
+        query, args = _render_many(query_template, params)
+        return await self.conn.executemany(query, args)
+
+    async def fetchmany(
+        self,
+        query_template,
+        params: typing.List[typing.Dict[str, typing.Any]],
+    ):
+        query, args = _render_many(query_template, params)
+        statement = await self.conn.prepare(query)
+        return [await statement.fetchrow(*a) for a in args]
+
+    async def fetch(
+        self,
+        query_template,
+        params: typing.Dict[str, typing.Any] = None,
+    ):
+        query, args = _render(query_template, params)
+        return await self.conn.fetch(query, *args)
+
+    async def fetchval(
+        self,
+        query_template,
+        params: typing.Dict[str, typing.Any] = None,
+    ):
+        query, args = _render(query_template, params)
+        return await self.conn.fetchval(query, *args)
+
+    async def copy_records(
+        self,
+        schema_name: str,
+        table_name: str,
+        columns: typing.List[str],
+        records: typing.Iterable[typing.Sequence],
+    ):
+        return await self.conn.copy_to_table(
+            table_name,
+            source=io.BytesIO(_csv_encode(records)),
+            columns=columns,
+            schema_name=schema_name,
+            format="csv",
+        )
+
+
+async def transaction(
+    pool: asyncpg.pool.Pool,
+    work: typing.Callable[[Transaction], typing.Awaitable],
+    age: bool = False,
+    retries: int = RETRIES,
+):
+    """
+    Run all statements of a unit of work on one connection in one transaction.
+    work is called with a Transaction and its result is returned. If the transaction fails
+    because of a serialization failure, a deadlock or a connection problem, it is rolled
+    back and work is run again, up to retries times.
+    """
+    attempt = 0
+    while True:
+        try:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    if _requires_age_init(pool, age):
+                        await _init_age(conn)
+                    return await work(Transaction(conn))
+        except RETRY_ERRORS:
+            if attempt >= retries:
+                raise
+            await asyncio.sleep(RETRY_DELAY * 2**attempt)
+            attempt += 1
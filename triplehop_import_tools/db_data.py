@@ -1,72 +1,49 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import io
+import itertools
 import json
+import os
+import queue
 import re
+import threading
 import time
 import typing
 
-import aiocache
 import asyncpg
 import rich.progress
 
-from triplehop_import_tools import db_base, db_structure
+from triplehop_import_tools import db_base, db_structure, lookup_tables
 
 RE_SOURCE_PROP_INDEX = re.compile(r"^(?P<property>[a-z_]*)\[(?P<index>[0-9]*)\]$")
+BATCH_SIZE = 5000
+# Number of resolved ids kept per lazy lookup
+LAZY_LOOKUP_CACHE_SIZE = 1000000
+# Number of offending values kept per type and property for the rejection summary
+REJECTION_SAMPLES = 10
+# Number of rejected rows that can wait to be written to the rejected rows file
+REJECTION_QUEUE_SIZE = 10000
 
 
-@aiocache.cached()
 async def get_entity_props_lookup(
     pool: asyncpg.pool.Pool,
     project_name: str,
     entity_type_name: str,
 ) -> typing.Dict:
-    result = await db_base.fetchval(
-        pool,
-        """
-            SELECT entity.config->'data'
-            FROM app.entity
-            INNER JOIN app.project
-                ON entity.project_id = project.id
-            WHERE project.system_name = :project_name
-                AND entity.system_name = :entity_type_name;
-        """,
-        {
-            "project_name": project_name,
-            "entity_type_name": entity_type_name,
-        },
-    )
-    if result:
-        config = json.loads(result)
-        if "fields" in config:
-            return {v["system_name"]: k for (k, v) in config["fields"].items()}
-    return {}
+    catalogue = await db_structure.get_catalogue(pool, project_name)
+    return catalogue.entity_props_lookup(entity_type_name)
 
 
-@aiocache.cached()
 async def get_relation_props_lookup(
     pool: asyncpg.pool.Pool,
     project_name: str,
     relation_type_name: str,
 ) -> typing.Dict:
-    result = await db_base.fetchval(
-        pool,
-        """
-            SELECT relation.config->'data'
-            FROM app.relation
-            INNER JOIN app.project
-                ON relation.project_id = project.id
-            WHERE project.system_name = :project_name
-                AND relation.system_name = :relation_type_name;
-        """,
-        {
-            "project_name": project_name,
-            "relation_type_name": relation_type_name,
-        },
-    )
-    if result:
-        config = json.loads(result)
-        if "fields" in config:
-            return {v["system_name"]: k for (k, v) in config["fields"].items()}
-    return {}
+    catalogue = await db_structure.get_catalogue(pool, project_name)
+    return catalogue.relation_props_lookup(relation_type_name)
 
 
 # If prefix is set, the placeholders should be prefixed, not the property keys themselves
@@ -163,28 +140,751 @@ def create_properties(
     return properties
 
 
+def _parse_int(value: str, _) -> int:
+    return int(value)
+
+
+def _parse_string(value: str, _) -> str:
+    return value
+
+
+def _parse_array(value: str, separator: str) -> typing.List[str]:
+    return value.split(separator)
+
+
+def _parse_geometry(value: str, _) -> typing.Any:
+    return json.loads(value)
+
+
+# key: type in the import config
+# value: parser, extra parser argument position in the import config
+PARSERS = {
+    "int": (_parse_int, None),
+    "string": (_parse_string, None),
+    "edtf": (_parse_string, None),
+    "[string]": (_parse_array, 2),
+    "geometry": (_parse_geometry, None),
+}
+
+
+class RowConverter:
+    """
+    Converter from csv.reader rows to age formatted properties for one import config.
+    Column indices, database keys and parsers are resolved once, so converting a row is a
+    loop over pre-bound operations. This is equivalent to create_properties followed by
+    age_format_properties, but avoids the per-cell type dispatch and lookups.
+    """
+
+    def __init__(
+        self,
+        fieldnames: typing.List[str],
+        db_props_lookup: typing.Dict,
+        prop_conf: typing.Dict,
+    ):
+        self.has_id = "id" in prop_conf
+        self.width = len(fieldnames)
+        # (column index, age key, parser, extra parser argument)
+        self.operations: typing.List[typing.Tuple] = []
+        for (key, conf) in prop_conf.items():
+            if conf[0] not in PARSERS:
+                raise Exception(f"Type {conf[0]} has not yet been implemented")
+            if key == "id":
+                if conf[0] != "int":
+                    raise Exception("Non-int ids are not yet implemented")
+                age_key = "id"
+            else:
+                age_key = f"p_{db_base.dtu(db_props_lookup[key])}"
+            (parser, arg_position) = PARSERS[conf[0]]
+            self.operations.append(
+                (
+                    fieldnames.index(conf[1]),
+                    age_key,
+                    parser,
+                    None if arg_position is None else conf[arg_position],
+                )
+            )
+
+    def __call__(self, row: typing.Sequence[str]) -> typing.Dict:
+        if len(row) < self.width:
+            row = [*row, *[""] * (self.width - len(row))]
+        properties = {}
+        for (index, age_key, parser, arg) in self.operations:
+            value = row[index]
+            if value == "":
+                continue
+            properties[age_key] = parser(value, arg)
+        return properties
+
+
+class WriteStats:
+    """Keep track of the number of rows written and the time spent writing them."""
+
+    def __init__(self, description: str):
+        self.description = description
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, rows: int, seconds: float) -> None:
+        self.rows += rows
+        self.seconds += seconds
+
+    def report(self) -> None:
+        if not self.seconds:
+            return
+        print(
+            f"{self.description} time: {self.seconds}, rows/second: {self.rows / self.seconds}"
+        )
+
+
+class RejectionSink:
+    """
+    Collect the values that could not be resolved during an import.
+    Rejections are counted per type and property and a limited number of sample values
+    is kept for the summary. With a filename, each rejected row is also written once to a
+    csv file by a background thread, so the import itself only waits for file I/O when
+    max_queued rows are waiting to be written. The first column lists the values of the
+    row that could not be resolved.
+    Use as context manager to start and stop the writer. If the file can't be written,
+    the error is raised when the context is left.
+    """
+
+    def __init__(
+        self,
+        description: str,
+        filename: str = None,
+        max_samples: int = REJECTION_SAMPLES,
+        max_queued: int = REJECTION_QUEUE_SIZE,
+    ):
+        self.description = description
+        self.filename = filename
+        self.max_samples = max_samples
+        self.max_queued = max_queued
+        self.counts: collections.Counter = collections.Counter()
+        self.samples: typing.Dict[
+            typing.Tuple[str, str], typing.List[typing.Any]
+        ] = collections.defaultdict(list)
+        self._queue: typing.Optional[queue.Queue] = None
+        self._thread: typing.Optional[threading.Thread] = None
+        self._error: typing.Optional[BaseException] = None
+
+    def __enter__(self) -> "RejectionSink":
+        if self.filename is not None:
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._queue = queue.Queue(maxsize=self.max_queued)
+            self._thread = threading.Thread(target=self._write, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+            self._thread = None
+            # Don't hide an error of the import itself
+            if self._error is not None and exc_type is None:
+                raise Exception(
+                    f"Rejected rows could not be written to {self.filename}"
+                ) from self._error
+
+    def _write(self) -> None:
+        try:
+            self._write_file()
+        except Exception as e:
+            self._error = e
+            # Keep taking rows from the queue, so reject_row never blocks on a full queue
+            while self._queue.get() is not None:
+                pass
+
+    def _write_file(self) -> None:
+        with open(self.filename, "w", newline="") as rejected_file:
+            writer = csv.writer(rejected_file)
+            header = False
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                (row, rejected) = item
+                if isinstance(row, dict):
+                    if not header:
+                        writer.writerow(["rejected", *row.keys()])
+                        header = True
+                    row = row.values()
+                writer.writerow(
+                    [
+                        "; ".join(
+                            f"{type_name} {prop_name} {value}"
+                            for (type_name, prop_name, value) in rejected
+                        ),
+                        *row,
+                    ]
+                )
+
+    def reject(
+        self,
+        type_name: str,
+        prop_name: str,
+        value: typing.Any,
+    ) -> typing.Tuple[str, str, typing.Any]:
+        """Count a value that could not be resolved and return it for reject_row."""
+        key = (type_name, prop_name)
+        self.counts[key] += 1
+        if len(self.samples[key]) < self.max_samples:
+            self.samples[key].append(value)
+        return (type_name, prop_name, value)
+
+    def reject_row(
+        self,
+        row: typing.Union[typing.Dict, typing.Sequence],
+        rejected: typing.List[typing.Tuple[str, str, typing.Any]],
+    ) -> None:
+        """Write a row with the values returned by reject to the rejected rows file."""
+        if self._queue is not None and self._error is None and rejected:
+            self._queue.put((row, rejected))
+
+    def report(self) -> None:
+        for ((type_name, prop_name), count) in self.counts.items():
+            samples = ", ".join(str(v) for v in self.samples[(type_name, prop_name)])
+            print(
+                f"{self.description}: {count} values not found in {type_name} {prop_name}"
+                f" (e.g. {samples})"
+            )
+        if self.counts and self.filename is not None and self._error is None:
+            print(f"{self.description}: rejected rows written to {self.filename}")
+
+
+async def reserve_ids(
+    pool: asyncpg.pool.Pool,
+    count_table: str,
+    type_id: str,
+    count: int,
+) -> int:
+    """
+    Atomically reserve a block of count consecutive ids for an entity or relation type.
+    count_table is either entity_count or relation_count. Returns the id preceding the
+    block, so the reserved ids are (result + 1) up to and including (result + count).
+    Concurrent importers or app writes can never be handed the same ids.
+    The reservation is committed on its own, before the batch that uses the ids is
+    written. If that batch is rolled back or retried, its block is not handed out again,
+    so the ids of a type are unique but can have gaps.
+    """
+    return await db_base.fetchval(
+        pool,
+        f"""
+            UPDATE app.{count_table}
+            SET current_id = current_id + :count
+            WHERE id = :type_id
+            RETURNING current_id - :count;
+        """,
+        {"count": count, "type_id": type_id},
+    )
+
+
+class CheckpointBatch:
+    """
+    Checkpoint update for a single batch.
+    The update is executed in the transaction that writes the batch, after the previous
+    batch has been committed, so the recorded row count always covers a contiguous range
+    of committed batches (also when batches are written by multiple writers).
+    """
+
+    def __init__(
+        self,
+        checkpoint: "Checkpoint",
+        counter: int,
+        previous: typing.Optional["CheckpointBatch"],
+    ):
+        self.checkpoint = checkpoint
+        self.counter = counter
+        self.previous = previous
+        self.committed = asyncio.Event()
+
+    async def record(self, tx: db_base.Transaction) -> None:
+        if self.previous is not None:
+            await self.previous.committed.wait()
+        await tx.execute(
+            """
+                UPDATE app.job
+                SET counter = :counter
+                WHERE id = :job_id;
+            """,
+            {"counter": self.counter, "job_id": self.checkpoint.job_id},
+        )
+
+    def commit(self) -> None:
+        self.checkpoint.counter = self.counter
+        self.committed.set()
+
+
+class Checkpoint:
+    """
+    Progress of an import, recorded in the app.job table so a failed import can be
+    resumed. counter is the number of data rows that have been committed.
+    """
+
+    def __init__(self, job_id: str, status: str, counter: int):
+        self.job_id = job_id
+        self.done = status == "done"
+        self.start = counter
+        self.counter = counter
+        self._last: typing.Optional[CheckpointBatch] = None
+
+    @property
+    def resumed(self) -> bool:
+        return self.start > 0
+
+    @classmethod
+    async def open(
+        cls,
+        pool: asyncpg.pool.Pool,
+        project_name: str,
+        username: str,
+        type: str,
+        entity_type_name: str = None,
+        relation_type_name: str = None,
+    ) -> "Checkpoint":
+        """
+        Get the checkpoint of the latest import of this type, or start a new one.
+        """
+        params = {
+            "project_id": await db_structure.get_project_id(pool, project_name),
+            "entity_id": None,
+            "relation_id": None,
+            "type": type,
+        }
+        if entity_type_name is not None:
+            params["entity_id"] = await db_structure.get_entity_type_id(
+                pool, project_name, entity_type_name
+            )
+        if relation_type_name is not None:
+            params["relation_id"] = await db_structure.get_relation_type_id(
+                pool, project_name, relation_type_name
+            )
+
+        records = await db_base.fetch(
+            pool,
+            """
+                SELECT id::text, status, counter
+                FROM app.job
+                WHERE project_id = :project_id
+                    AND entity_id IS NOT DISTINCT FROM :entity_id::uuid
+                    AND relation_id IS NOT DISTINCT FROM :relation_id::uuid
+                    AND type = :type
+                ORDER BY created DESC
+                LIMIT 1;
+            """,
+            params,
+        )
+        if records:
+            record = records[0]
+            if record["status"] != "done":
+                await db_base.execute(
+                    pool,
+                    """
+                        UPDATE app.job
+                        SET status = 'running', started = now(), ended = NULL
+                        WHERE id = :job_id;
+                    """,
+                    {"job_id": record["id"]},
+                )
+            return cls(record["id"], record["status"], record["counter"] or 0)
+
+        job_id = await db_base.fetchval(
+            pool,
+            """
+                INSERT INTO app.job
+                    (user_id, project_id, entity_id, relation_id, type, status, counter, started)
+                VALUES (
+                    :user_id,
+                    :project_id,
+                    :entity_id,
+                    :relation_id,
+                    :type,
+                    'running',
+                    0,
+                    now()
+                )
+                RETURNING id::text;
+            """,
+            {
+                **params,
+                "user_id": await db_structure.get_user_id(pool, username),
+            },
+        )
+        return cls(job_id, "running", 0)
+
+    def batch(self, counter: int) -> CheckpointBatch:
+        self._last = CheckpointBatch(self, counter, self._last)
+        return self._last
+
+    async def finish(self, pool: asyncpg.pool.Pool) -> None:
+        await db_base.execute(
+            pool,
+            """
+                UPDATE app.job
+                SET status = 'done', counter = :counter, total = :counter, ended = now()
+                WHERE id = :job_id;
+            """,
+            {"counter": self.counter, "job_id": self.job_id},
+        )
+        self.done = True
+
+    async def fail(self, pool: asyncpg.pool.Pool) -> None:
+        await db_base.execute(
+            pool,
+            """
+                UPDATE app.job
+                SET status = 'failed', ended = now()
+                WHERE id = :job_id;
+            """,
+            {"job_id": self.job_id},
+        )
+
+
+@contextlib.asynccontextmanager
+async def track(
+    pool: asyncpg.pool.Pool,
+    checkpoint: typing.Optional[Checkpoint],
+) -> typing.AsyncIterator[None]:
+    """Mark the checkpoint (if any) as done or failed depending on the outcome."""
+    if checkpoint is None:
+        yield
+        return
+    try:
+        yield
+    except Exception:
+        await checkpoint.fail(pool)
+        raise
+    await checkpoint.finish(pool)
+
+
+async def write_batch(job: typing.Dict, work: typing.Callable) -> typing.Any:
+    """
+    Run work(tx, write_stats) for a prepared job in a transaction that is retried as a
+    whole. Every attempt gets its own write stats, only those of the attempt that was
+    committed are added to the stats of the job.
+    """
+    attempt_stats: typing.Optional[WriteStats] = None
+
+    async def attempt(tx: db_base.Transaction) -> typing.Any:
+        nonlocal attempt_stats
+        if job["write_stats"] is not None:
+            attempt_stats = WriteStats(job["write_stats"].description)
+        return await work(tx, attempt_stats)
+
+    result = await db_base.transaction(job["pool"], attempt, True)
+    if attempt_stats is not None:
+        job["write_stats"].add(attempt_stats.rows, attempt_stats.seconds)
+    return result
+
+
+async def record_checkpoint(tx: db_base.Transaction, job: typing.Dict) -> None:
+    """
+    Record the checkpoint of a batch (if any) in the transaction that writes it.
+    This waits until the previous batch has been committed, so rows that every batch
+    locks (such as the id count of a type) must only be updated after it. Otherwise a
+    later batch could hold such a lock while waiting for an earlier one that needs it,
+    which the database can't detect as a deadlock.
+    """
+    if job.get("checkpoint") is not None:
+        await job["checkpoint"].record(tx)
+
+
+async def insert_edges(
+    tx: db_base.Transaction,
+    project_id: str,
+    label: str,
+    edges: typing.List[typing.Dict],
+    write_stats: WriteStats = None,
+    method: str = "copy",
+) -> None:
+    """
+    Write edges into the label table of a graph.
+    Each edge is a dict with the graphids of the start and end vertex as `domain_id` and
+    `range_id`; all other keys are stored as edge properties.
+    Method `copy` streams the edges with a single COPY, method `executemany` uses one
+    INSERT per edge.
+    """
+    if not edges:
+        return
+    start_time = time.time()
+    records = [
+        (
+            edge["domain_id"],
+            edge["range_id"],
+            json.dumps(
+                {k: v for (k, v) in edge.items() if k not in ["domain_id", "range_id"]}
+            ),
+        )
+        for edge in edges
+    ]
+    if method == "copy":
+        await tx.copy_records(
+            project_id,
+            label,
+            ["start_id", "end_id", "properties"],
+            records,
+        )
+    elif method == "executemany":
+        await tx.executemany(
+            (
+                f"INSERT INTO "
+                f'"{project_id}".{label} '
+                f"(start_id, end_id, properties) "
+                f"VALUES (:domain_id, :range_id, :properties) "
+            ),
+            [
+                {
+                    "domain_id": record[0],
+                    "range_id": record[1],
+                    "properties": record[2],
+                }
+                for record in records
+            ],
+        )
+    else:
+        raise Exception(f"Edge write method {method} has not yet been implemented")
+    if write_stats is not None:
+        write_stats.add(len(records), time.time() - start_time)
+
+
+async def insert_vertices(
+    tx: db_base.Transaction,
+    project_id: str,
+    label: str,
+    vertices: typing.List[typing.Dict],
+    write_stats: WriteStats = None,
+    method: str = "copy",
+) -> typing.Dict[int, str]:
+    """
+    Write vertices into the label table of a graph and return a mapping from the id
+    property of each vertex to its graphid.
+    Each vertex is a dict with the (age formatted) vertex properties, including `id`.
+    Method `copy` allocates the graphids from the label sequence in bulk and streams the
+    vertices with a single COPY, method `cypher` uses a cypher CREATE per vertex.
+    """
+    if not vertices:
+        return {}
+    start_time = time.time()
+    if method == "copy":
+        records = await tx.fetch(
+            (
+                f"SELECT _graphid("
+                f"    _label_id('{project_id}', '{label}'),"
+                f"    nextval('\"{project_id}\".{label}_id_seq')"
+                f")::text AS nid "
+                f"FROM generate_series(1, :count);"
+            ),
+            {"count": len(vertices)},
+        )
+        nids = [record["nid"] for record in records]
+        await tx.copy_records(
+            project_id,
+            label,
+            ["id", "properties"],
+            [(nid, json.dumps(vertex)) for (nid, vertex) in zip(nids, vertices)],
+        )
+        index = {vertex["id"]: nid for (nid, vertex) in zip(nids, vertices)}
+    elif method == "cypher":
+        # key: placeholder string
+        # value: typing.List with corresponding parameters
+        props_collection: typing.Dict[str, typing.List] = {}
+        for vertex in vertices:
+            placeholder = ", ".join([f"{k}: ${k}" for k in vertex.keys()])
+            if placeholder in props_collection:
+                props_collection[placeholder].append(vertex)
+            else:
+                props_collection[placeholder] = [vertex]
+        index = {}
+        for placeholder in props_collection:
+            records = await tx.fetchmany(
+                (
+                    f"SELECT * FROM cypher("
+                    f"'{project_id}', "
+                    f"$$CREATE (n\\:{label} {{{placeholder}}}) RETURN id(n), n.id$$, :params"
+                    f") as (nid agtype, id agtype);"
+                ),
+                [
+                    {"params": json.dumps(params)}
+                    for params in props_collection[placeholder]
+                ],
+            )
+            for record in records:
+                index[json.loads(record["id"])] = record["nid"]
+    else:
+        raise Exception(f"Vertex write method {method} has not yet been implemented")
+    if write_stats is not None:
+        write_stats.add(len(vertices), time.time() - start_time)
+    return index
+
+
+@contextlib.contextmanager
+def open_data(
+    filename: str,
+    reader: typing.Callable = csv.DictReader,
+) -> typing.Iterator[typing.Tuple[typing.Iterator, typing.BinaryIO]]:
+    """
+    Open a csv file in the data folder for streaming.
+    Yields the csv reader (csv.DictReader or csv.reader) together with the underlying
+    binary file, of which the position is used to report progress.
+    """
+    with open(f"data/{filename}", "rb") as data_file:
+        with io.TextIOWrapper(data_file, newline="") as text_file:
+            yield reader(text_file), data_file
+
+
+def read_batches(
+    data: typing.Iterable,
+    batch_size: int = BATCH_SIZE,
+) -> typing.Iterator[typing.List]:
+    """Lazily split an iterable in lists of at most batch_size items."""
+    iterator = iter(data)
+    while True:
+        rows = list(itertools.islice(iterator, batch_size))
+        if not rows:
+            return
+        yield rows
+
+
+# Progress display shared by imports running concurrently (rich only allows one live
+# display at a time), together with the number of imports using it
+_progress: typing.Optional[rich.progress.Progress] = None
+_progress_users = 0
+
+
+@contextlib.contextmanager
+def progress_task(
+    message: str,
+    total: typing.Optional[int],
+) -> typing.Iterator[typing.Tuple[rich.progress.Progress, rich.progress.TaskID]]:
+    """
+    Add a task to the shared progress display.
+    The display is started by the first import using it and stopped when the last one
+    finishes.
+    """
+    global _progress, _progress_users
+    if _progress is None:
+        _progress = rich.progress.Progress()
+        _progress.start()
+    _progress_users += 1
+    progress = _progress
+    try:
+        yield (progress, progress.add_task(message, total=total))
+    finally:
+        _progress_users -= 1
+        if _progress_users == 0:
+            progress.stop()
+            _progress = None
+
+
 async def batch(
     method: typing.Callable,
     data: csv.DictReader,
     message: str,
+    data_file: typing.BinaryIO = None,
+    batch_size: int = BATCH_SIZE,
     **kwargs,
 ):
+    """
+    Call method with kwargs for consecutive batches of data, one batch at a time.
+    The imports in this module use pipeline; this is kept as public API for scripts that
+    import their own data. With the underlying binary file of data, progress is reported
+    by file position, otherwise by the number of rows.
+    """
     counter = 0
-    batch = []
-    data_sequence = [r for r in data]
     start_time = time.time()
-    for row in rich.progress.track(data_sequence, description=message):
-        counter += 1
-        batch.append(row)
-        if not counter % 5000:
-            await method(**kwargs, batch=batch)
-            batch = []
-    if len(batch):
-        await method(**kwargs, batch=batch)
+    total = None if data_file is None else os.fstat(data_file.fileno()).st_size
+    with progress_task(message, total) as (progress, task):
+        for rows in read_batches(data, batch_size):
+            counter += len(rows)
+            await method(**kwargs, batch=rows)
+            progress.update(
+                task, completed=counter if data_file is None else data_file.tell()
+            )
     total_time = time.time() - start_time
-    print(
-        f"Total time: {total_time}, iterations/second: {len(data_sequence) / total_time}"
-    )
+    print(f"Total time: {total_time}, iterations/second: {counter / total_time}")
+
+
+async def pipeline(
+    prepare: typing.Callable,
+    write: typing.Callable,
+    data: csv.DictReader,
+    message: str,
+    data_file: typing.BinaryIO,
+    consumers: int = 1,
+    queue_size: int = None,
+    checkpoint: Checkpoint = None,
+    batch_size: int = BATCH_SIZE,
+    **kwargs,
+):
+    """
+    Import data in batches, preparing the next batches while previous ones are written.
+    A single producer reads and prepares the batches in order (`prepare` is called with
+    kwargs and the batch) and puts the resulting jobs on a bounded queue; `consumers`
+    writers take jobs from the queue and write them (`write` is called with the job).
+    The queue size limits the number of prepared batches kept in memory. Each writer uses
+    its own pool connections, so the pool should be at least `consumers` large.
+    With a checkpoint, the rows that have already been committed are skipped and every
+    job gets a "checkpoint" batch that `write` records (see record_checkpoint).
+    """
+    if queue_size is None:
+        queue_size = 2 * consumers
+    jobs: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    counter = 0
+    start_time = time.time()
+
+    total = os.fstat(data_file.fileno()).st_size
+    with progress_task(message, total) as (progress, task):
+
+        async def produce():
+            nonlocal counter
+            position = 0
+            rows_read = 0
+            if checkpoint is not None and checkpoint.counter:
+                # Skip the rows that have been committed before
+                collections.deque(itertools.islice(data, checkpoint.counter), maxlen=0)
+                rows_read = checkpoint.counter
+                position = data_file.tell()
+                progress.advance(task, position)
+            for rows in read_batches(data, batch_size):
+                counter += len(rows)
+                rows_read += len(rows)
+                job = await prepare(**kwargs, batch=rows)
+                if checkpoint is not None:
+                    job["checkpoint"] = checkpoint.batch(rows_read)
+                # Report progress in bytes once the batch has been written
+                new_position = data_file.tell()
+                await jobs.put((job, new_position - position))
+                position = new_position
+            for _ in range(consumers):
+                await jobs.put(None)
+
+        async def consume():
+            while True:
+                item = await jobs.get()
+                if item is None:
+                    return
+                (job, size) = item
+                await write(job)
+                if checkpoint is not None:
+                    job["checkpoint"].commit()
+                progress.advance(task, size)
+
+        tasks = [
+            asyncio.ensure_future(produce()),
+            *[asyncio.ensure_future(consume()) for _ in range(consumers)],
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            raise
+
+    total_time = time.time() - start_time
+    print(f"Total time: {total_time}, iterations/second: {counter / total_time}")
 
 
 async def import_entities(
@@ -194,34 +894,108 @@ async def import_entities(
     conf: typing.Dict,
     lookups: typing.Dict,
     lookup_props: typing.List[str],
+    vertex_write_method: str = "copy",
+    consumers: int = 1,
+    workers: int = 0,
+    resume: bool = False,
+    incremental_index: bool = False,
+    executor: concurrent.futures.Executor = None,
 ):
-    with open(f'data/{conf["filename"]}') as data_file:
-        data_reader = csv.DictReader(data_file)
-
-        params = {
-            "project_name": project_name,
-            "entity_type_name": conf["entity_type_name"],
-            "username": username,
-        }
-
-        db_props_lookup = await get_entity_props_lookup(
-            pool=pool,
-            project_name=project_name,
+    """
+    Import entities from a csv file.
+    With workers > 0, the csv rows are converted in a pool of that many worker processes.
+    An executor that is shared with other imports can be passed instead of creating one.
+    With resume, progress is recorded in a checkpoint: an import that failed continues
+    after its last committed batch and a finished import is skipped.
+    With incremental_index, the index table is filled in the transaction of every vertex
+    batch instead of being rebuilt afterwards. It is then correct at all times, so
+    entities can also be appended to an existing entity type.
+    """
+    checkpoint = None
+    if resume:
+        checkpoint = await Checkpoint.open(
+            pool,
+            project_name,
+            username,
+            "import_entities",
             entity_type_name=conf["entity_type_name"],
         )
+    if checkpoint is not None and checkpoint.done:
+        print(f'Entity {conf["entity_type_name"]} has already been imported')
+    else:
+        async with track(pool, checkpoint):
+            write_stats = WriteStats(f'Entity {conf["entity_type_name"]} vertex write')
+            project_id = await db_structure.get_project_id(pool, project_name)
+            entity_type_id = await db_structure.get_entity_type_id(
+                pool, project_name, conf["entity_type_name"]
+            )
+            # id -> graphid of the created vertices, used to populate the index table
+            index: typing.Optional[typing.Dict[int, str]] = None
+            if incremental_index:
+                await create_entity_index_table(pool, project_id, entity_type_id)
+            else:
+                index = {}
+            with contextlib.ExitStack() as stack:
+                (data_reader, data_file) = stack.enter_context(
+                    open_data(conf["filename"], csv.reader)
+                )
+                fieldnames = next(data_reader)
+                if executor is None and workers:
+                    executor = stack.enter_context(
+                        concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+                    )
+
+                params = {
+                    "project_name": project_name,
+                    "entity_type_name": conf["entity_type_name"],
+                    "username": username,
+                }
 
-        await batch(
-            method=create_entities,
-            data=data_reader,
-            message=f'Importing entity {conf["entity_type_name"]}',
-            pool=pool,
-            params=params,
-            db_props_lookup=db_props_lookup,
-            prop_conf=conf["props"],
-        )
+                db_props_lookup = await get_entity_props_lookup(
+                    pool=pool,
+                    project_name=project_name,
+                    entity_type_name=conf["entity_type_name"],
+                )
+
+                await pipeline(
+                    prepare=prepare_entities,
+                    write=write_entities,
+                    # Like csv.DictReader, skip blank lines. Checkpoints count the
+                    # remaining rows, so resuming skips the same rows.
+                    data=(row for row in data_reader if row),
+                    data_file=data_file,
+                    message=f'Importing entity {conf["entity_type_name"]}',
+                    pool=pool,
+                    params=params,
+                    converter=RowConverter(fieldnames, db_props_lookup, conf["props"]),
+                    write_stats=write_stats,
+                    vertex_write_method=vertex_write_method,
+                    index=index,
+                    executor=executor,
+                    index_table=incremental_index,
+                    consumers=consumers,
+                    checkpoint=checkpoint,
+                    # Keep enough batches in flight to occupy all worker processes
+                    queue_size=2 * max(consumers, workers),
+                )
+            write_stats.report()
 
-    print(f'Creating lookup and index for entity {conf["entity_type_name"]}')
+            print(f'Creating index and lookup for entity {conf["entity_type_name"]}')
+
+            if incremental_index:
+                await create_entity_label_index(pool, project_id, entity_type_id)
+            else:
+                await create_entity_index(
+                    pool=pool,
+                    project_name=project_name,
+                    entity_type_name=conf["entity_type_name"],
+                    # Rows committed before the resume are not in index
+                    index=(
+                        None if checkpoint is not None and checkpoint.resumed else index
+                    ),
+                )
 
+    # Id lookups are read from the index table
     if conf["entity_type_name"] not in lookups:
         lookups[conf["entity_type_name"]] = {}
     for lookup_prop in lookup_props:
@@ -233,90 +1007,150 @@ async def import_entities(
             type="entity",
         )
 
-    await create_entity_index(
-        pool=pool,
-        project_name=project_name,
-        entity_type_name=conf["entity_type_name"],
-    )
+
+def transform_entities(
+    batch: typing.List,
+    converter: RowConverter,
+    first_id: int = None,
+) -> typing.Tuple[typing.List[typing.Dict], int]:
+    """
+    Convert csv rows into age formatted vertex properties.
+    If the ids are not part of the data, they are numbered consecutively from first_id + 1.
+    Returns the vertices and the highest id. This is a pure function, so it can be run in
+    a worker process.
+    """
+    if converter.has_id:
+        vertices = [converter(row) for row in batch]
+        return (vertices, max([vertex["id"] for vertex in vertices], default=0))
+
+    vertices = []
+    id = first_id
+    for row in batch:
+        vertex = converter(row)
+        id += 1
+        vertex["id"] = id
+        vertices.append(vertex)
+    return (vertices, id)
 
 
-async def create_entities(
+async def prepare_entities(
     pool: asyncpg.pool.Pool,
     params: typing.Dict,
-    db_props_lookup: typing.Dict,
-    prop_conf: typing.Dict,
+    converter: RowConverter,
     batch: typing.List,
-) -> None:
-    project_id = await db_structure.get_project_id(pool, params["project_name"])
-    entity_type_id = await db_structure.get_entity_type_id(
-        pool, params["project_name"], params["entity_type_name"]
-    )
-
-    if "id" not in prop_conf:
-        id = await db_base.fetchval(
-            pool,
-            """
-                SELECT current_id
-                FROM app.entity_count
-                WHERE id = :entity_type_id;
-            """,
-            {"entity_type_id": entity_type_id},
+    write_stats: WriteStats = None,
+    vertex_write_method: str = "copy",
+    index: typing.Dict[int, str] = None,
+    executor: concurrent.futures.Executor = None,
+    index_table: bool = False,
+) -> typing.Dict:
+    catalogue = await db_structure.get_catalogue(pool, params["project_name"])
+    project_id = catalogue.project_id
+    entity_type_id = catalogue.entity_type_id(params["entity_type_name"])
+
+    first_id = None
+    if not converter.has_id:
+        # Ids are handed out before the rows are transformed, so they don't depend on
+        # the order in which worker processes finish (and are not reused when the batch
+        # is not written, see reserve_ids)
+        first_id = await reserve_ids(pool, "entity_count", entity_type_id, len(batch))
+
+    loop = asyncio.get_event_loop()
+    if executor is None:
+        transformed = loop.create_future()
+        transformed.set_result(transform_entities(batch, converter, first_id))
+    else:
+        transformed = loop.run_in_executor(
+            executor,
+            transform_entities,
+            batch,
+            converter,
+            first_id,
         )
-    max_id = 0
-    # key: placeholder string
-    # value: typing.List with corresponding parameters
-    props_collection: typing.Dict[str, typing.List] = {}
 
-    for row in batch:
-        properties = create_properties(
-            row=row,
-            db_props_lookup=db_props_lookup,
-            prop_conf=prop_conf,
+    return {
+        "pool": pool,
+        "project_id": project_id,
+        "entity_type_id": entity_type_id,
+        "has_id": converter.has_id,
+        "transformed": transformed,
+        "write_stats": write_stats,
+        "vertex_write_method": vertex_write_method,
+        "index": index,
+        "index_table": index_table,
+    }
+
+
+async def write_entities(job: typing.Dict) -> typing.Dict[int, str]:
+    entity_type_id = job["entity_type_id"]
+    (vertices, max_id) = await job["transformed"]
+
+    async def work(
+        tx: db_base.Transaction, write_stats: typing.Optional[WriteStats]
+    ) -> typing.Dict[int, str]:
+        batch_index = await insert_vertices(
+            tx,
+            job["project_id"],
+            f"n_{db_base.dtu(entity_type_id)}",
+            vertices,
+            write_stats,
+            job["vertex_write_method"],
         )
-        if "id" in prop_conf:
-            max_id = max(max_id, properties["id"]["value"])
-        else:
-            id += 1
-            max_id = id
-            properties["id"] = {
-                "type": "int",
-                "value": id,
-            }
+        if job["index_table"]:
+            # Keep the index table in sync with the vertices
+            await tx.copy_records(
+                job["project_id"],
+                f"_i_n_{db_base.dtu(entity_type_id)}",
+                ["id", "nid"],
+                batch_index.items(),
+            )
+        await record_checkpoint(tx, job)
+        # Ids from the data are not reserved, make sure the count is not behind them.
+        # The count row is locked after the checkpoint wait, so a batch never holds it
+        # while waiting for an earlier batch that needs it.
+        if job["has_id"]:
+            await tx.execute(
+                """
+                    UPDATE app.entity_count
+                    SET current_id = GREATEST(current_id, :entity_id)
+                    WHERE id = :entity_type_id;
+                """,
+                {"entity_id": max_id, "entity_type_id": entity_type_id},
+            )
+        return batch_index
 
-        props = age_format_properties(properties)
-        if props[0] in props_collection:
-            props_collection[props[0]].append(props[1])
-        else:
-            props_collection[props[0]] = [props[1]]
+    batch_index = await write_batch(job, work)
+    if job["index"] is not None:
+        job["index"].update(batch_index)
 
-    # GREATEST is needed when id in prop_conf
-    await db_base.execute(
-        pool,
-        """
-            UPDATE app.entity_count
-            SET current_id = GREATEST(current_id, :entity_id)
-            WHERE id = :entity_type_id;
-        """,
-        {"entity_id": max_id, "entity_type_id": entity_type_id},
-    )
+    # TODO: revision
 
-    for placeholder in props_collection:
-        await db_base.executemany(
-            pool,
-            (
-                f"SELECT * FROM cypher("
-                f"'{project_id}', "
-                f"$$CREATE (\\:n_{db_base.dtu(entity_type_id)} {{{placeholder}}})$$, :params"
-                f") as (a agtype);"
-            ),
-            [
-                {"params": json.dumps(params)}
-                for params in props_collection[placeholder]
-            ],
-            True,
-        )
+    return batch_index
 
-    # TODO: revision
+
+async def create_entities(
+    pool: asyncpg.pool.Pool,
+    params: typing.Dict,
+    converter: RowConverter,
+    batch: typing.List,
+    write_stats: WriteStats = None,
+    vertex_write_method: str = "copy",
+    index: typing.Dict[int, str] = None,
+    executor: concurrent.futures.Executor = None,
+    index_table: bool = False,
+) -> typing.Dict[int, str]:
+    job = await prepare_entities(
+        pool=pool,
+        params=params,
+        converter=converter,
+        batch=batch,
+        write_stats=write_stats,
+        vertex_write_method=vertex_write_method,
+        index=index,
+        executor=executor,
+        index_table=index_table,
+    )
+    return await write_entities(job)
 
 
 async def import_relations(
@@ -325,47 +1159,103 @@ async def import_relations(
     username: str,
     conf: typing.Dict,
     lookups: typing.Dict = None,
+    edge_write_method: str = "copy",
+    vertex_write_method: str = "copy",
+    consumers: int = 1,
+    lazy_lookups: bool = False,
+    resume: bool = False,
+    rejected_filename: str = None,
 ):
-    with open(f'data/{conf["filename"]}') as data_file:
-        data_reader = csv.DictReader(data_file)
+    """
+    Import relations from a csv file.
+    With lazy_lookups, domain and range ids are resolved per batch through the index
+    tables of the domain and range entity types instead of through lookups.
+    With resume, progress is recorded in a checkpoint (see import_entities).
+    Domain and range values that can't be resolved are summarised at the end; with
+    rejected_filename, the rows containing them are written to that csv file.
+    """
+    checkpoint = None
+    if resume:
+        checkpoint = await Checkpoint.open(
+            pool,
+            project_name,
+            username,
+            "import_relations",
+            relation_type_name=conf["relation_type_name"],
+        )
+    if checkpoint is not None and checkpoint.done:
+        print(f'Relation {conf["relation_type_name"]} has already been imported')
+        return
+    async with track(pool, checkpoint):
+        write_stats = WriteStats(f'Relation {conf["relation_type_name"]} edge write')
+        # id -> graphid of the created relation entities, used to populate the index table
+        index: typing.Dict[int, str] = {}
+        if lazy_lookups:
+            lookups = await create_lazy_lookups(
+                pool,
+                project_name,
+                [
+                    (conf["domain_type_name"], list(conf["domain"].keys())[0]),
+                    (conf["range_type_name"], list(conf["range"].keys())[0]),
+                ],
+            )
+        rejections = RejectionSink(
+            f'Relation {conf["relation_type_name"]}', rejected_filename
+        )
+        with open_data(conf["filename"]) as (data_reader, data_file), rejections:
+
+            params = {
+                "project_name": project_name,
+                "relation_type_name": conf["relation_type_name"],
+                "domain_type_name": conf["domain_type_name"],
+                "range_type_name": conf["range_type_name"],
+                "username": username,
+            }
 
-        params = {
-            "project_name": project_name,
-            "relation_type_name": conf["relation_type_name"],
-            "domain_type_name": conf["domain_type_name"],
-            "range_type_name": conf["range_type_name"],
-            "username": username,
-        }
+            db_props_lookup = await get_relation_props_lookup(
+                pool=pool,
+                project_name=project_name,
+                relation_type_name=conf["relation_type_name"],
+            )
 
-        db_props_lookup = await get_relation_props_lookup(
-            pool=pool,
-            project_name=project_name,
-            relation_type_name=conf["relation_type_name"],
+            await pipeline(
+                prepare=prepare_relations,
+                write=write_relations,
+                data=data_reader,
+                data_file=data_file,
+                message=f'Importing relation {conf["relation_type_name"]}',
+                pool=pool,
+                params=params,
+                db_props_lookup=db_props_lookup,
+                domain_conf=conf["domain"],
+                range_conf=conf["range"],
+                prop_conf=conf["props"],
+                lookups=lookups,
+                write_stats=write_stats,
+                edge_write_method=edge_write_method,
+                vertex_write_method=vertex_write_method,
+                index=index,
+                rejections=rejections,
+                consumers=consumers,
+                checkpoint=checkpoint,
+            )
+        write_stats.report()
+        rejections.report()
+
+        print(
+            f'Creating lookup and index for relation entity {conf["relation_type_name"]}'
         )
 
-        await batch(
-            method=create_relations,
-            data=data_reader,
-            message=f'Importing relation {conf["relation_type_name"]}',
+        await create_relation_entity_index(
             pool=pool,
-            params=params,
-            db_props_lookup=db_props_lookup,
-            domain_conf=conf["domain"],
-            range_conf=conf["range"],
-            prop_conf=conf["props"],
-            lookups=lookups,
+            project_name=project_name,
+            relation_type_name=conf["relation_type_name"],
+            # Relation entities committed before the resume are not in index
+            index=None if checkpoint is not None and checkpoint.resumed else index,
         )
 
-    print(f'Creating lookup and index for relation entity {conf["relation_type_name"]}')
-
-    await create_relation_entity_index(
-        pool=pool,
-        project_name=project_name,
-        relation_type_name=conf["relation_type_name"],
-    )
 
-
-async def create_relations(
+async def prepare_relations(
     pool: asyncpg.pool.Pool,
     params: typing.Dict,
     db_props_lookup: typing.Dict,
@@ -374,62 +1264,77 @@ async def create_relations(
     prop_conf: typing.Dict,
     lookups: typing.Dict,
     batch: typing.List,
-) -> None:
-    project_id = await db_structure.get_project_id(pool, params["project_name"])
-    relation_type_id = await db_structure.get_relation_type_id(
-        pool, params["project_name"], params["relation_type_name"]
-    )
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+    vertex_write_method: str = "copy",
+    index: typing.Dict[int, str] = None,
+    rejections: RejectionSink = None,
+) -> typing.Dict:
+    catalogue = await db_structure.get_catalogue(pool, params["project_name"])
+    project_id = catalogue.project_id
+    relation_type_id = catalogue.relation_type_id(params["relation_type_name"])
+
+    batch_rejections = None
+    if rejections is None:
+        # Report the rejections of this batch only
+        batch_rejections = RejectionSink(f'Relation {params["relation_type_name"]}')
+        rejections = batch_rejections
 
-    if "id" not in prop_conf:
-        id = await db_base.fetchval(
-            pool,
-            """
-                SELECT current_id
-                FROM app.relation_count
-                WHERE id = :relation_type_id;
-            """,
-            {"relation_type_id": relation_type_id},
-        )
     max_id = 0
     # key: placeholder strings separated by | (domain_placeholder|range_placeholder|placeholder)
     # value: typing.List with corresponding parameters
     props_collection: typing.Dict[str, typing.List] = {}
 
     d_entity_type_name = params["domain_type_name"]
-    d_prop_name = list(domain_conf.keys())[0]
+    (d_prop_name, d_conf) = list(domain_conf.items())[0]
     r_entity_type_name = params["range_type_name"]
-    r_prop_name = list(range_conf.keys())[0]
-
-    for row in batch:
-        properties = create_properties(row, db_props_lookup, prop_conf)
-
+    (r_prop_name, r_conf) = list(range_conf.items())[0]
+
+    # Parse the domain and range values of all rows first, so lazy lookups can resolve
+    # them with a single query per batch
+    d_row_values = [parse_lookup_values(row[d_conf[1]], d_conf[0]) for row in batch]
+    r_row_values = [parse_lookup_values(row[r_conf[1]], r_conf[0]) for row in batch]
+    d_lookup = lookups[d_entity_type_name][d_prop_name]
+    if isinstance(d_lookup, LazyLookup):
+        d_lookup = await d_lookup.resolve(itertools.chain.from_iterable(d_row_values))
+    r_lookup = lookups[r_entity_type_name][r_prop_name]
+    if isinstance(r_lookup, LazyLookup):
+        r_lookup = await r_lookup.resolve(itertools.chain.from_iterable(r_row_values))
+
+    # Resolve all endpoints first, so the number of edges (and thus of ids) is known
+    # before any id is handed out
+    resolved = []
+    edge_count = 0
+    for (row, d_prop_values, r_prop_values) in zip(batch, d_row_values, r_row_values):
+        rejected = []
         domain_prop_values = []
-        d_prop_values = row[list(domain_conf.values())[0][1]].split("|")
         for d_prop_value in d_prop_values:
-            if d_prop_value == "":
-                continue
-            if list(domain_conf.values())[0][0] == "int":
-                d_prop_value = int(d_prop_value)
-            if d_prop_value not in lookups[d_entity_type_name][d_prop_name]:
-                print(f"{d_prop_value} not found in {d_entity_type_name} {d_prop_name}")
+            if d_prop_value not in d_lookup:
+                rejected.append(
+                    rejections.reject(d_entity_type_name, d_prop_name, d_prop_value)
+                )
                 continue
-            domain_prop_values.append(
-                lookups[d_entity_type_name][d_prop_name][d_prop_value]
-            )
+            domain_prop_values.append(d_lookup[d_prop_value])
 
         range_prop_values = []
-        r_prop_values = row[list(range_conf.values())[0][1]].split("|")
         for r_prop_value in r_prop_values:
-            if r_prop_value == "":
-                continue
-            if list(range_conf.values())[0][0] == "int":
-                r_prop_value = int(r_prop_value)
-            if r_prop_value not in lookups[r_entity_type_name][r_prop_name]:
-                print(f"{r_prop_value} not found in {r_entity_type_name} {r_prop_name}")
+            if r_prop_value not in r_lookup:
+                rejected.append(
+                    rejections.reject(r_entity_type_name, r_prop_name, r_prop_value)
+                )
                 continue
-            range_prop_values.append(
-                lookups[r_entity_type_name][r_prop_name][r_prop_value]
-            )
+            range_prop_values.append(r_lookup[r_prop_value])
+        rejections.reject_row(row, rejected)
+
+        resolved.append((row, domain_prop_values, range_prop_values))
+        edge_count += len(domain_prop_values) * len(range_prop_values)
+
+    if "id" not in prop_conf:
+        # Not reused when the batch is not written, see reserve_ids
+        id = await reserve_ids(pool, "relation_count", relation_type_id, edge_count)
+
+    for (row, domain_prop_values, range_prop_values) in resolved:
+        properties = create_properties(row, db_props_lookup, prop_conf)
 
         for domain_prop_value in domain_prop_values:
             for range_prop_value in range_prop_values:
@@ -455,60 +1360,243 @@ async def create_relations(
                 }
                 props_collection[key].append(value)
 
-    # GREATEST is needed when id in prop_conf
-    await db_base.execute(
-        pool,
-        """
-            UPDATE app.relation_count
-            SET current_id = GREATEST(current_id, :relation_id)
-            WHERE id = :relation_type_id;
-        """,
-        {"relation_id": max_id, "relation_type_id": relation_type_id},
+    if batch_rejections is not None:
+        batch_rejections.report()
+
+    return {
+        "pool": pool,
+        "project_id": project_id,
+        "relation_type_id": relation_type_id,
+        "has_id": "id" in prop_conf,
+        "max_id": max_id,
+        "props_collection": props_collection,
+        "write_stats": write_stats,
+        "edge_write_method": edge_write_method,
+        "vertex_write_method": vertex_write_method,
+        "index": index,
+    }
+
+
+async def write_relations(job: typing.Dict) -> None:
+    project_id = job["project_id"]
+    relation_type_id = job["relation_type_id"]
+    props_collection = job["props_collection"]
+
+    async def work(
+        tx: db_base.Transaction, write_stats: typing.Optional[WriteStats]
+    ) -> typing.Dict[int, str]:
+        batch_index = {}
+        for placeholder in props_collection:
+            await insert_edges(
+                tx,
+                project_id,
+                f"e_{db_base.dtu(relation_type_id)}",
+                props_collection[placeholder],
+                write_stats,
+                job["edge_write_method"],
+            )
+            # Create relation entities to enable source relations
+            batch_index.update(
+                await insert_vertices(
+                    tx,
+                    project_id,
+                    f"en_{db_base.dtu(relation_type_id)}",
+                    [{"id": params["id"]} for params in props_collection[placeholder]],
+                    method=job["vertex_write_method"],
+                )
+            )
+        await record_checkpoint(tx, job)
+        # Ids from the data are not reserved, make sure the count is not behind them
+        # (after the checkpoint wait, see write_entities)
+        if job["has_id"]:
+            await tx.execute(
+                """
+                    UPDATE app.relation_count
+                    SET current_id = GREATEST(current_id, :relation_id)
+                    WHERE id = :relation_type_id;
+                """,
+                {"relation_id": job["max_id"], "relation_type_id": relation_type_id},
+            )
+        return batch_index
+
+    batch_index = await write_batch(job, work)
+    if job["index"] is not None:
+        job["index"].update(batch_index)
+
+    # TODO: revision
+
+
+async def create_relations(
+    pool: asyncpg.pool.Pool,
+    params: typing.Dict,
+    db_props_lookup: typing.Dict,
+    domain_conf: typing.Dict,
+    range_conf: typing.Dict,
+    prop_conf: typing.Dict,
+    lookups: typing.Dict,
+    batch: typing.List,
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+    vertex_write_method: str = "copy",
+    index: typing.Dict[int, str] = None,
+    rejections: RejectionSink = None,
+) -> None:
+    job = await prepare_relations(
+        pool=pool,
+        params=params,
+        db_props_lookup=db_props_lookup,
+        domain_conf=domain_conf,
+        range_conf=range_conf,
+        prop_conf=prop_conf,
+        lookups=lookups,
+        batch=batch,
+        write_stats=write_stats,
+        edge_write_method=edge_write_method,
+        vertex_write_method=vertex_write_method,
+        index=index,
+        rejections=rejections,
     )
+    await write_relations(job)
 
-    for placeholder in props_collection:
-        query = (
-            f"INSERT INTO "
-            f'"{project_id}".e_{db_base.dtu(relation_type_id)} '
-            f"(start_id, end_id, properties) "
-            f"VALUES (:domain_id, :range_id, :properties) "
-        )
-        await db_base.executemany(
-            pool,
-            query,
-            [
-                {
-                    "domain_id": params["domain_id"],
-                    "range_id": params["range_id"],
-                    "properties": json.dumps(
-                        {
-                            k: params[k]
-                            for k in params
-                            if k not in ["domain_id", "range_id"]
-                        }
-                    ),
-                }
-                for params in props_collection[placeholder]
-            ],
-            True,
-        )
-        # Create relation entities to enable source relations
-        await db_base.executemany(
+
+async def get_lookup_fingerprint(
+    pool: asyncpg.pool.Pool,
+    project_id: str,
+    label: str,
+) -> typing.Tuple[int, ...]:
+    """
+    Cheap fingerprint of the state of a label table, without scanning it: the oid of the
+    table, which changes when the graph is dropped and recreated, the last value of the
+    label sequence, which changes on every insert, and the number of inserted, updated
+    and deleted rows from the table statistics. The statistics are only updated when a
+    transaction ends and can be reported with a short delay.
+    """
+    records = await db_base.fetch(
+        pool,
+        (
+            f"SELECT"
+            f"    table_oid::bigint AS oid,"
+            f'    (SELECT last_value FROM "{project_id}".{label}_id_seq) AS last_value,'
+            f"    pg_stat_get_tuples_inserted(table_oid) AS inserted,"
+            f"    pg_stat_get_tuples_updated(table_oid) AS updated,"
+            f"    pg_stat_get_tuples_deleted(table_oid) AS deleted "
+            f"FROM (SELECT '\"{project_id}\".{label}'::regclass::oid AS table_oid) AS t;"
+        ),
+    )
+    return tuple(
+        records[0][column]
+        for column in ["oid", "last_value", "inserted", "updated", "deleted"]
+    )
+
+
+async def read_index_lookup(
+    pool: asyncpg.pool.Pool,
+    project_id: str,
+    label: str,
+) -> typing.Optional[lookup_tables.IntLookup]:
+    """Read the id lookup of a label from its index table, if that table exists."""
+    try:
+        records = await db_base.fetch(
             pool,
             (
-                f"SELECT * FROM cypher("
-                f"'{project_id}', "
-                f"$$CREATE (\\:en_{db_base.dtu(relation_type_id)} {{id: $id}})$$, :params"
-                f") as (a agtype);"
+                f"SELECT id, nid::text::bigint AS nid "
+                f'FROM "{project_id}"._i_{label};'
             ),
-            [
-                {"params": json.dumps({"id": params["id"]})}
-                for params in props_collection[placeholder]
-            ],
-            True,
         )
+    except asyncpg.exceptions.UndefinedTableError:
+        return None
+    return lookup_tables.IntLookup.from_pairs(
+        (record["id"], record["nid"]) for record in records
+    )
+
+
+async def fetch_index(
+    pool: asyncpg.pool.Pool,
+    project_id: str,
+    label: str,
+    ids: typing.List[int],
+) -> typing.Dict[int, str]:
+    """
+    Look up the graphids of a batch of ids in the index table of a label.
+    Ids that aren't found are left out of the result.
+    """
+    records = await db_base.fetch(
+        pool,
+        (
+            f"SELECT id, nid::text AS nid "
+            f'FROM "{project_id}"._i_{label} '
+            f"WHERE id = ANY(:ids::int[]);"
+        ),
+        {"ids": ids},
+    )
+    return {record["id"]: record["nid"] for record in records}
+
+
+class LazyLookup:
+    """
+    Lookup from ids to graphids that is resolved on demand through the index table of a
+    label, with one query per batch.
+    Resolved ids are kept in a bounded LRU cache that is shared across batches, so the
+    lookup never holds a map of the whole type.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.pool.Pool,
+        project_id: str,
+        label: str,
+        max_size: int = LAZY_LOOKUP_CACHE_SIZE,
+    ):
+        self.pool = pool
+        self.project_id = project_id
+        self.label = label
+        self.max_size = max_size
+        self.cache: collections.OrderedDict = collections.OrderedDict()
+
+    async def resolve(self, ids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        """Return a mapping to graphids for the ids that exist."""
+        result = {}
+        missing = []
+        for id in set(ids):
+            if id in self.cache:
+                self.cache.move_to_end(id)
+                result[id] = self.cache[id]
+            else:
+                missing.append(id)
+        if missing:
+            fetched = await fetch_index(self.pool, self.project_id, self.label, missing)
+            result.update(fetched)
+            self.cache.update(fetched)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        return result
+
+
+async def create_lazy_lookups(
+    pool: asyncpg.pool.Pool,
+    project_name: str,
+    type_props: typing.List[typing.Tuple[str, str]],
+) -> typing.Dict:
+    """Create lazy lookups for (entity type name, property name) pairs, in the format of lookups."""
+    project_id = await db_structure.get_project_id(pool, project_name)
+    result: typing.Dict = {}
+    for (entity_type_name, prop_name) in type_props:
+        if prop_name != "id":
+            raise Exception("Lazy lookups are only implemented for ids")
+        entity_type_id = await db_structure.get_entity_type_id(
+            pool, project_name, entity_type_name
+        )
+        result.setdefault(entity_type_name, {})[prop_name] = LazyLookup(
+            pool, project_id, f"n_{db_base.dtu(entity_type_id)}"
+        )
+    return result
 
-    # TODO: revision
+
+def parse_lookup_values(value: str, type: str) -> typing.List:
+    """Split a | separated list of property values used to look up vertices."""
+    if type == "int":
+        return [int(v) for v in value.split("|") if v != ""]
+    return [v for v in value.split("|") if v != ""]
 
 
 async def create_lookup(
@@ -517,12 +1605,23 @@ async def create_lookup(
     type_name: str,
     prop_name: str,
     type: str,
-) -> typing.Dict:
+    use_cache: bool = True,
+) -> typing.Mapping:
+    """
+    Create a lookup from property values to graphids for all vertices of an entity type
+    or all relation entities of a relation type.
+    Id lookups are read from the index table of the label if it exists, other lookups
+    (and id lookups without index table) with a cypher query.
+    With use_cache, integer id lookups are persisted in the on-disk lookup cache and
+    reused as long as the label table hasn't changed. Lookups on other properties are
+    not cached, as they can be edited in the app.
+    """
     project_id = await db_structure.get_project_id(pool, project_name)
     if type == "entity":
         entity_type_id = await db_structure.get_entity_type_id(
             pool, project_name, type_name
         )
+        label = f"n_{db_base.dtu(entity_type_id)}"
 
         if prop_name == "id":
             key = "id"
@@ -531,58 +1630,59 @@ async def create_lookup(
                 pool, project_name, type_name
             )
             key = f"p_{db_base.dtu(db_props_lookup[prop_name])}"
-
-        records = await db_base.fetch(
-            pool,
-            (
-                f"SELECT * FROM cypher("
-                f"'{project_id}', "
-                f"$$MATCH"
-                f"        (n:n_{db_base.dtu(entity_type_id)})"
-                f"return id(n), n.{key}$$"
-                f") as (id agtype, prop agtype);"
-            ),
-            {},
-            True,
-        )
-        return {json.loads(record["prop"]): record["id"] for record in records}
     else:
         relation_type_id = await db_structure.get_relation_type_id(
             pool, project_name, type_name
         )
+        label = f"en_{db_base.dtu(relation_type_id)}"
+        key = "id"
+
+    use_cache = use_cache and key == "id"
+    if use_cache:
+        fingerprint = await get_lookup_fingerprint(pool, project_id, label)
+        lookup = lookup_tables.load_lookup(project_id, label, key, fingerprint)
+        if lookup is not None:
+            return lookup
+
+    lookup = None
+    if key == "id":
+        lookup = await read_index_lookup(pool, project_id, label)
+    if lookup is None:
         records = await db_base.fetch(
             pool,
             (
                 f"SELECT * FROM cypher("
                 f"'{project_id}', "
                 f"$$MATCH"
-                f"        (n:en_{db_base.dtu(relation_type_id)})"
-                f"return id(n), n.id$$"
+                f"        (n:{label})"
+                f"return id(n), n.{key}$$"
                 f") as (id agtype, prop agtype);"
             ),
             {},
             True,
         )
-        return {json.loads(record["prop"]): record["id"] for record in records}
+        lookup = lookup_tables.build_lookup(
+            (json.loads(record["prop"]), record["id"]) for record in records
+        )
 
+    if use_cache:
+        lookup_tables.save_lookup(project_id, label, key, fingerprint, lookup)
+    return lookup
 
-async def create_entity_index(
-    pool: asyncpg.pool.Pool,
-    project_name: str,
-    entity_type_name: str,
-) -> None:
-    project_id = await db_structure.get_project_id(pool, project_name)
-    entity_type_id = await db_structure.get_entity_type_id(
-        pool, project_name, entity_type_name
-    )
 
+async def read_index(
+    pool: asyncpg.pool.Pool,
+    project_id: str,
+    label: str,
+) -> typing.Dict[int, str]:
+    """Scan all vertices of a label and return a mapping from their id property to their graphid."""
     records = await db_base.fetch(
         pool,
         (
             f"SELECT * FROM cypher("
             f"'{project_id}', "
             f"$$MATCH"
-            f"        (n:n_{db_base.dtu(entity_type_id)})"
+            f"        (n:{label})"
             f"return n$$"
             f") as (n agtype);"
         ),
@@ -590,21 +1690,24 @@ async def create_entity_index(
         True,
     )
 
-    index = []
+    index = {}
     for raw_record in records:
         record = json.loads(raw_record["n"][:-8])
-        index.append(
-            {
-                "id": record["properties"]["id"],
-                "nid": str(record["id"]),
-            }
-        )
+        index[record["properties"]["id"]] = str(record["id"])
+    return index
+
 
+async def create_entity_index_table(
+    pool: asyncpg.pool.Pool,
+    project_id: str,
+    entity_type_id: str,
+) -> None:
+    """Create the (empty) index table for an entity type if it doesn't exist yet."""
     # Primary key is indexed automatically
     await db_base.execute(
         pool,
         (
-            f'CREATE TABLE "{project_id}"._i_n_{db_base.dtu(entity_type_id)} ('
+            f'CREATE TABLE IF NOT EXISTS "{project_id}"._i_n_{db_base.dtu(entity_type_id)} ('
             f"    id INT PRIMARY KEY,"
             f"    nid GRAPHID"
             f");"
@@ -613,56 +1716,98 @@ async def create_entity_index(
         True,
     )
 
-    await db_base.executemany(
-        pool,
-        (
-            f'INSERT INTO "{project_id}"._i_n_{db_base.dtu(entity_type_id)} '
-            f"(id, nid) "
-            f"VALUES (:id, :nid);"
-        ),
-        index,
-        True,
-    )
 
+async def create_entity_label_index(
+    pool: asyncpg.pool.Pool,
+    project_id: str,
+    entity_type_id: str,
+) -> None:
+    """
+    Index the id property of the vertices of an entity type.
+    Maintaining the index while loading is expensive, so it is created once the entity
+    type has been fully loaded.
+    """
     await db_base.execute(
         pool,
-        f"CREATE INDEX n_{db_base.dtu(entity_type_id)}__id "
+        f"CREATE INDEX IF NOT EXISTS n_{db_base.dtu(entity_type_id)}__id "
         f'ON "{project_id}".n_{db_base.dtu(entity_type_id)}(id)',
     )
 
 
+async def create_entity_index(
+    pool: asyncpg.pool.Pool,
+    project_name: str,
+    entity_type_name: str,
+    index: typing.Dict[int, str] = None,
+) -> None:
+    """
+    Create or extend the index table for an entity type.
+    If the id -> graphid mapping of the vertices isn't provided, it is read from the graph
+    and the index table is rebuilt from it.
+    """
+    project_id = await db_structure.get_project_id(pool, project_name)
+    entity_type_id = await db_structure.get_entity_type_id(
+        pool, project_name, entity_type_name
+    )
+
+    if index is None:
+        index = await read_index(pool, project_id, f"n_{db_base.dtu(entity_type_id)}")
+        # The scan contains all vertices, so the index table can be rebuilt from it
+        await db_base.execute(
+            pool,
+            f'DROP TABLE IF EXISTS "{project_id}"._i_n_{db_base.dtu(entity_type_id)};',
+            {},
+            True,
+        )
+        await create_entity_index_table(pool, project_id, entity_type_id)
+        await db_base.copy_records(
+            pool,
+            project_id,
+            f"_i_n_{db_base.dtu(entity_type_id)}",
+            ["id", "nid"],
+            index.items(),
+            True,
+        )
+    else:
+        await create_entity_index_table(pool, project_id, entity_type_id)
+        # The index table might already contain entities from a previous import
+        await db_base.execute(
+            pool,
+            (
+                f'INSERT INTO "{project_id}"._i_n_{db_base.dtu(entity_type_id)} '
+                f"(id, nid) "
+                f"SELECT id, nid::graphid "
+                f"FROM unnest(:ids::int[], :nids::text[]) AS index (id, nid) "
+                f"ON CONFLICT DO NOTHING;"
+            ),
+            {
+                "ids": list(index.keys()),
+                "nids": list(index.values()),
+            },
+            True,
+        )
+
+    await create_entity_label_index(pool, project_id, entity_type_id)
+
+
 async def create_relation_entity_index(
     pool: asyncpg.pool.Pool,
     project_name: str,
     relation_type_name: str,
+    index: typing.Dict[int, str] = None,
 ) -> None:
+    """
+    Create or extend the index table for the relation entities of a relation type.
+    If the id -> graphid mapping of the vertices isn't provided, it is read from the graph.
+    """
     project_id = await db_structure.get_project_id(pool, project_name)
     relation_type_id = await db_structure.get_relation_type_id(
         pool, project_name, relation_type_name
     )
 
-    records = await db_base.fetch(
-        pool,
-        (
-            f"SELECT * FROM cypher("
-            f"'{project_id}', "
-            f"$$MATCH"
-            f"        (n:en_{db_base.dtu(relation_type_id)})"
-            f"return n$$"
-            f") as (n agtype);"
-        ),
-        {},
-        True,
-    )
-
-    index = []
-    for raw_record in records:
-        record = json.loads(raw_record["n"][:-8])
-        index.append(
-            {
-                "id": record["properties"]["id"],
-                "nid": str(record["id"]),
-            }
+    if index is None:
+        index = await read_index(
+            pool, project_id, f"en_{db_base.dtu(relation_type_id)}"
         )
 
     # Primary key is indexed automatically
@@ -678,15 +1823,20 @@ async def create_relation_entity_index(
         True,
     )
 
-    await db_base.executemany(
+    # The index table might already contain relation entities from a previous import
+    await db_base.execute(
         pool,
         (
             f'INSERT INTO "{project_id}"._i_en_{db_base.dtu(relation_type_id)} '
             f"(id, nid) "
-            f"VALUES (:id, :nid) "
+            f"SELECT id, nid::graphid "
+            f"FROM unnest(:ids::int[], :nids::text[]) AS index (id, nid) "
             f"ON CONFLICT DO NOTHING;"
         ),
-        index,
+        {
+            "ids": list(index.keys()),
+            "nids": list(index.values()),
+        },
         True,
     )
 
@@ -720,144 +1870,274 @@ async def import_entity_source_relations(
     username: str,
     conf: typing.Dict,
     lookups: typing.Dict,
+    edge_write_method: str = "copy",
+    consumers: int = 1,
+    resume: bool = False,
+    rejected_filename: str = None,
 ):
-    with open(f'data/{conf["filename"]}') as data_file:
-        data_reader = csv.DictReader(data_file)
-
-        params = {
-            "project_name": project_name,
-            "username": username,
-        }
-
-        await batch(
-            method=create_entity_source_relations,
-            data=data_reader,
-            message="Importing entity sources",
-            pool=pool,
-            params=params,
-            lookups=lookups,
+    """
+    Import entity sources from a csv file.
+    Rows of which the entity or source can't be resolved are summarised at the end;
+    with rejected_filename, they are written to that csv file.
+    """
+    checkpoint = None
+    if resume:
+        # Source files are distinguished by filename
+        checkpoint = await Checkpoint.open(
+            pool,
+            project_name,
+            username,
+            f'import_entity_sources:{conf["filename"]}',
+            relation_type_name="_source_",
         )
+    if checkpoint is not None and checkpoint.done:
+        print(f'Entity sources {conf["filename"]} have already been imported')
+        return
+    async with track(pool, checkpoint):
+        write_stats = WriteStats("Entity source edge write")
+        rejections = RejectionSink("Entity sources", rejected_filename)
+        with open_data(conf["filename"]) as (data_reader, data_file), rejections:
+
+            params = {
+                "project_name": project_name,
+                "username": username,
+            }
 
+            await pipeline(
+                prepare=prepare_entity_source_relations,
+                write=write_entity_source_relations,
+                data=data_reader,
+                data_file=data_file,
+                message="Importing entity sources",
+                pool=pool,
+                params=params,
+                lookups=lookups,
+                write_stats=write_stats,
+                edge_write_method=edge_write_method,
+                # Memoised property translations are kept for the whole file
+                translators={},
+                rejections=rejections,
+                consumers=consumers,
+                checkpoint=checkpoint,
+            )
+        write_stats.report()
+        rejections.report()
 
-async def create_entity_source_relations(
-    pool: asyncpg.pool.Pool,
-    params: typing.Dict,
-    lookups: typing.Dict,
-    batch: typing.List,
-) -> None:
-    project_id = await db_structure.get_project_id(pool, params["project_name"])
-
-    # group parameters by domain, range and source properties to be added
-    props_collection: typing.Dict[str, typing.List] = {}
-
-    id = await db_base.fetchval(
-        pool,
-        """
-            SELECT current_id
-            FROM app.relation_count
-            INNER JOIN app.relation on relation_count.id = relation.id
-            WHERE relation.system_name = :relation_type_name
-        """,
-        {"relation_type_name": "_source_"},
-    )
-
-    for row in batch:
-        # Add domain and range to lookups
-        for et in [row["entity_type"], row["source_type"]]:
-            if et not in lookups:
-                lookups[et] = await create_lookup(
-                    pool=pool,
-                    project_name=params["project_name"],
-                    type_name=et,
-                    prop_name="id",
-                    type="entity",
-                )
-
-        # Check if the entity and source nodes exist
-        if int(row["entity_id"]) not in lookups[row["entity_type"]]:
-            print(f'{row["entity_id"]} not found in {row["entity_type"]}')
-            continue
-        if int(row["source_id"]) not in lookups[row["source_type"]]:
-            print(f'{row["source_id"]} not found in {row["source_type"]}')
-            continue
-
-        source_props_placeholder = "id : $id, properties: $properties"
-        key = f"$domain_id|$range_id|{source_props_placeholder}"
 
-        if key not in props_collection:
-            props_collection[key] = []
+class PropertyTranslator:
+    """
+    Translate the |-separated property references of source rows (system names,
+    optionally with an index, e.g. title|authors[2]) to property ids.
+    Property reference strings are highly repetitive, so translations are memoised.
+    """
 
-        # Create lookup to convert property system names to property ids
-        props_lookup = await get_entity_props_lookup(
-            pool, params["project_name"], row["entity_type"]
-        )
+    def __init__(self, props_lookup: typing.Dict[str, str]):
+        self.props_lookup = props_lookup
+        self.cache: typing.Dict[str, typing.List[str]] = {}
 
-        id += 1
+    def translate(self, properties: str) -> typing.List[str]:
         uuid_props = []
-        for p in row["properties"].split("|"):
+        for p in properties.split("|"):
             m = RE_SOURCE_PROP_INDEX.match(p)
             if m:
                 uuid_props.append(
-                    f'{props_lookup[m.group("property")]}[{m.group("index")}]'
+                    f'{self.props_lookup[m.group("property")]}[{m.group("index")}]'
                 )
             else:
-                uuid_props.append(props_lookup[p])
+                uuid_props.append(self.props_lookup[p])
+        return uuid_props
+
+    def __call__(self, properties: str) -> typing.List[str]:
+        if properties not in self.cache:
+            self.cache[properties] = self.translate(properties)
+        # Each edge gets its own list
+        return list(self.cache[properties])
+
+
+def group_source_rows(
+    batch: typing.List[typing.Dict],
+    domain_type_column: str,
+    range_type_column: str,
+) -> typing.Dict[typing.Tuple[str, str], typing.List[typing.Dict]]:
+    """Group source rows by their domain and range type."""
+    groups: typing.Dict[typing.Tuple[str, str], typing.List[typing.Dict]] = {}
+    for row in batch:
+        key = (row[domain_type_column], row[range_type_column])
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(row)
+    return groups
+
+
+def create_source_edges(
+    rows: typing.List[typing.Dict],
+    domain_type_name: str,
+    domain_id_column: str,
+    domain_lookup: typing.Mapping,
+    range_type_name: str,
+    range_lookup: typing.Mapping,
+    translator: PropertyTranslator,
+    rejections: RejectionSink,
+) -> typing.List[typing.Dict]:
+    """
+    Create the source edge properties for a group of rows with the same domain and range
+    type. All lookups have been loaded beforehand, so no database access is needed.
+    """
+    edges = []
+    for row in rows:
+        domain_id = int(row[domain_id_column])
+        range_id = int(row["source_id"])
+        # Check if the domain and source nodes exist
+        rejected = []
+        if domain_id not in domain_lookup:
+            rejected.append(rejections.reject(domain_type_name, "id", domain_id))
+        if range_id not in range_lookup:
+            rejected.append(rejections.reject(range_type_name, "id", range_id))
+        if rejected:
+            rejections.reject_row(row, rejected)
+            continue
 
         props = {
-            "domain_id": lookups[row["entity_type"]][int(row["entity_id"])],
-            "range_id": lookups[row["source_type"]][int(row["source_id"])],
-            "id": id,
-            "properties": uuid_props,
+            "domain_id": domain_lookup[domain_id],
+            "range_id": range_lookup[range_id],
+            "properties": translator(row["properties"]),
         }
         # Only add source_props if not empty
         if row["source_props"]:
             props["source_props"] = json.loads(row["source_props"])
-        props_collection[key].append(props)
+        edges.append(props)
+    return edges
 
-    for placeholder in props_collection:
-        query = (
-            f"INSERT INTO "
-            f'"{project_id}"._source_ '
-            f"(start_id, end_id, properties) "
-            f"VALUES (:domain_id, :range_id, :properties) "
-        )
-        await db_base.executemany(
-            pool,
-            query,
-            [
-                {
-                    "domain_id": params["domain_id"],
-                    "range_id": params["range_id"],
-                    "properties": json.dumps(
-                        {
-                            k: params[k]
-                            for k in params
-                            if k not in ["domain_id", "range_id"]
-                        }
-                    ),
-                }
-                for params in props_collection[placeholder]
-            ],
-            True,
+
+async def prepare_source_relations(
+    pool: asyncpg.pool.Pool,
+    params: typing.Dict,
+    edges: typing.List[typing.Dict],
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+) -> typing.Dict:
+    """Number the source edges of a batch and create the write job."""
+    catalogue = await db_structure.get_catalogue(pool, params["project_name"])
+    project_id = catalogue.project_id
+    source_type_id = catalogue.relation_type_id("_source_")
+
+    # Not reused when the batch is not written, see reserve_ids
+    id = await reserve_ids(pool, "relation_count", source_type_id, len(edges))
+    for props in edges:
+        id += 1
+        props["id"] = id
+
+    source_props_placeholder = "id : $id, properties: $properties"
+    key = f"$domain_id|$range_id|{source_props_placeholder}"
+    return {
+        "pool": pool,
+        "project_id": project_id,
+        # group parameters by domain, range and source properties to be added
+        "props_collection": {key: edges} if edges else {},
+        "write_stats": write_stats,
+        "edge_write_method": edge_write_method,
+    }
+
+
+async def prepare_entity_source_relations(
+    pool: asyncpg.pool.Pool,
+    params: typing.Dict,
+    lookups: typing.Dict,
+    batch: typing.List,
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+    translators: typing.Dict[str, PropertyTranslator] = None,
+    rejections: RejectionSink = None,
+) -> typing.Dict:
+    if translators is None:
+        translators = {}
+    batch_rejections = None
+    if rejections is None:
+        # Report the rejections of this batch only
+        batch_rejections = RejectionSink("Entity sources")
+        rejections = batch_rejections
+    catalogue = await db_structure.get_catalogue(pool, params["project_name"])
+    groups = group_source_rows(batch, "entity_type", "source_type")
+
+    # Load all lookups and translators needed for this batch up front
+    for (et, st) in groups:
+        for type_name in [et, st]:
+            if type_name not in lookups:
+                lookups[type_name] = await create_lookup(
+                    pool=pool,
+                    project_name=params["project_name"],
+                    type_name=type_name,
+                    prop_name="id",
+                    type="entity",
+                )
+        if et not in translators:
+            # Converts property system names to property ids
+            translators[et] = PropertyTranslator(catalogue.entity_props_lookup(et))
+
+    edges: typing.List[typing.Dict] = []
+    for ((et, st), rows) in groups.items():
+        edges.extend(
+            create_source_edges(
+                rows,
+                et,
+                "entity_id",
+                lookups[et],
+                st,
+                lookups[st],
+                translators[et],
+                rejections,
+            )
         )
+    if batch_rejections is not None:
+        batch_rejections.report()
 
-    await db_base.execute(
-        pool,
-        """
-            UPDATE app.relation_count
-            SET current_id = :id
-            WHERE id = (
-                SELECT id FROM app.relation
-                WHERE project_id = :project_id
-                AND system_name = :relation_type_name
+    return await prepare_source_relations(
+        pool, params, edges, write_stats, edge_write_method
+    )
+
+
+async def write_entity_source_relations(job: typing.Dict) -> None:
+    project_id = job["project_id"]
+    props_collection = job["props_collection"]
+
+    async def work(
+        tx: db_base.Transaction, write_stats: typing.Optional[WriteStats]
+    ) -> None:
+        for placeholder in props_collection:
+            await insert_edges(
+                tx,
+                project_id,
+                "_source_",
+                props_collection[placeholder],
+                write_stats,
+                job["edge_write_method"],
             )
-        """,
-        {
-            "id": id,
-            "project_id": project_id,
-            "relation_type_name": "_source_",
-        },
+        await record_checkpoint(tx, job)
+
+    await write_batch(job, work)
+
+
+async def create_entity_source_relations(
+    pool: asyncpg.pool.Pool,
+    params: typing.Dict,
+    lookups: typing.Dict,
+    batch: typing.List,
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+    translators: typing.Dict[str, PropertyTranslator] = None,
+    rejections: RejectionSink = None,
+) -> None:
+    job = await prepare_entity_source_relations(
+        pool=pool,
+        params=params,
+        lookups=lookups,
+        batch=batch,
+        write_stats=write_stats,
+        edge_write_method=edge_write_method,
+        translators=translators,
+        rejections=rejections,
     )
+    await write_entity_source_relations(job)
 
 
 async def import_relation_source_relations(
@@ -866,147 +2146,338 @@ async def import_relation_source_relations(
     username: str,
     conf: typing.Dict,
     lookups: typing.Dict,
+    edge_write_method: str = "copy",
+    consumers: int = 1,
+    resume: bool = False,
+    rejected_filename: str = None,
 ):
-    with open(f'data/{conf["filename"]}') as data_file:
-        data_reader = csv.DictReader(data_file)
-
-        params = {
-            "project_name": project_name,
-            "username": username,
-        }
-
-        await batch(
-            method=create_relation_source_relations,
-            data=data_reader,
-            message="Importing relation sources",
-            pool=pool,
-            params=params,
-            lookups=lookups,
+    """
+    Import relation sources from a csv file.
+    Rows of which the relation or source can't be resolved are summarised at the end;
+    with rejected_filename, they are written to that csv file.
+    """
+    checkpoint = None
+    if resume:
+        # Source files are distinguished by filename
+        checkpoint = await Checkpoint.open(
+            pool,
+            project_name,
+            username,
+            f'import_relation_sources:{conf["filename"]}',
+            relation_type_name="_source_",
         )
+    if checkpoint is not None and checkpoint.done:
+        print(f'Relation sources {conf["filename"]} have already been imported')
+        return
+    async with track(pool, checkpoint):
+        write_stats = WriteStats("Relation source edge write")
+        rejections = RejectionSink("Relation sources", rejected_filename)
+        with open_data(conf["filename"]) as (data_reader, data_file), rejections:
+
+            params = {
+                "project_name": project_name,
+                "username": username,
+            }
 
+            await pipeline(
+                prepare=prepare_relation_source_relations,
+                write=write_relation_source_relations,
+                data=data_reader,
+                data_file=data_file,
+                message="Importing relation sources",
+                pool=pool,
+                params=params,
+                lookups=lookups,
+                write_stats=write_stats,
+                edge_write_method=edge_write_method,
+                # Memoised property translations are kept for the whole file
+                translators={},
+                rejections=rejections,
+                consumers=consumers,
+                checkpoint=checkpoint,
+            )
+        write_stats.report()
+        rejections.report()
 
-async def create_relation_source_relations(
+
+async def prepare_relation_source_relations(
     pool: asyncpg.pool.Pool,
     params: typing.Dict,
     lookups: typing.Dict,
     batch: typing.List,
-) -> None:
-    project_id = await db_structure.get_project_id(pool, params["project_name"])
-
-    # group parameters by domain, range and source properties to be added
-    props_collection: typing.Dict[str, typing.List] = {}
-
-    id = await db_base.fetchval(
-        pool,
-        """
-            SELECT current_id
-            FROM app.relation_count
-            INNER JOIN app.relation on relation_count.id = relation.id
-            WHERE relation.system_name = :relation_type_name
-        """,
-        {"relation_type_name": "_source_"},
-    )
-
-    for row in batch:
-        # Add domain and range to lookups
-        rt = row["relation_type"]
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+    translators: typing.Dict[str, PropertyTranslator] = None,
+    rejections: RejectionSink = None,
+) -> typing.Dict:
+    if translators is None:
+        translators = {}
+    batch_rejections = None
+    if rejections is None:
+        # Report the rejections of this batch only
+        batch_rejections = RejectionSink("Relation sources")
+        rejections = batch_rejections
+    catalogue = await db_structure.get_catalogue(pool, params["project_name"])
+    groups = group_source_rows(batch, "relation_type", "source_type")
+
+    # Load all lookups and translators needed for this batch up front
+    for (rt, st) in groups:
         if f"r_{rt}" not in lookups:
             lookups[f"r_{rt}"] = await create_lookup(
                 pool, params["project_name"], rt, "id", "relation"
             )
-
-        et = row["source_type"]
-        if f"e_{et}" not in lookups:
-            lookups[f"e_{et}"] = await create_lookup(
+        if f"e_{st}" not in lookups:
+            lookups[f"e_{st}"] = await create_lookup(
                 pool=pool,
                 project_name=params["project_name"],
-                type_name=et,
+                type_name=st,
                 prop_name="id",
                 type="entity",
             )
+        if rt not in translators:
+            # Converts property system names to property ids
+            translators[rt] = PropertyTranslator(
+                {**catalogue.relation_props_lookup(rt), "__rel__": "__rel__"}
+            )
 
-        # Check if the entity and source nodes exist
-        if int(row["relation_id"]) not in lookups[f'r_{row["relation_type"]}']:
-            print(f'{row["relation_id"]} not found in {row["relation_type"]}')
-            continue
-        if int(row["source_id"]) not in lookups[f'e_{row["source_type"]}']:
-            print(f'{row["source_id"]} not found in {row["source_type"]}')
-            continue
+    edges: typing.List[typing.Dict] = []
+    for ((rt, st), rows) in groups.items():
+        edges.extend(
+            create_source_edges(
+                rows,
+                rt,
+                "relation_id",
+                lookups[f"r_{rt}"],
+                st,
+                lookups[f"e_{st}"],
+                translators[rt],
+                rejections,
+            )
+        )
+    if batch_rejections is not None:
+        batch_rejections.report()
 
-        source_props_placeholder = "id : $id, properties: $properties"
-        key = f"$domain_id|$range_id|{source_props_placeholder}"
+    return await prepare_source_relations(
+        pool, params, edges, write_stats, edge_write_method
+    )
 
-        if key not in props_collection:
-            props_collection[key] = []
 
-        # Create lookup to convert property system names to property ids
-        props_lookup = await get_relation_props_lookup(
-            pool, params["project_name"], row["relation_type"]
-        )
-        props_lookup["__rel__"] = "__rel__"
+async def write_relation_source_relations(job: typing.Dict) -> None:
+    project_id = job["project_id"]
+    props_collection = job["props_collection"]
+
+    async def work(
+        tx: db_base.Transaction, write_stats: typing.Optional[WriteStats]
+    ) -> None:
+        for placeholder in props_collection:
+            await insert_edges(
+                tx,
+                project_id,
+                "_source_",
+                props_collection[placeholder],
+                write_stats,
+                job["edge_write_method"],
+            )
+        await record_checkpoint(tx, job)
+
+    await write_batch(job, work)
+
+
+async def create_relation_source_relations(
+    pool: asyncpg.pool.Pool,
+    params: typing.Dict,
+    lookups: typing.Dict,
+    batch: typing.List,
+    write_stats: WriteStats = None,
+    edge_write_method: str = "copy",
+    translators: typing.Dict[str, PropertyTranslator] = None,
+    rejections: RejectionSink = None,
+) -> None:
+    job = await prepare_relation_source_relations(
+        pool=pool,
+        params=params,
+        lookups=lookups,
+        batch=batch,
+        write_stats=write_stats,
+        edge_write_method=edge_write_method,
+        translators=translators,
+        rejections=rejections,
+    )
+    await write_relation_source_relations(job)
 
-        id += 1
-        uuid_props = []
-        for p in row["properties"].split("|"):
-            m = RE_SOURCE_PROP_INDEX.match(p)
-            if m:
-                uuid_props.append(
-                    f'{props_lookup[m.group("property")]}[{m.group("index")}]'
-                )
-            else:
-                uuid_props.append(props_lookup[p])
-        props = {
-            "domain_id": lookups[f'r_{row["relation_type"]}'][int(row["relation_id"])],
-            "range_id": lookups[f'e_{row["source_type"]}'][int(row["source_id"])],
-            "id": id,
-            "properties": uuid_props,
-        }
-        # Only add source_props if not empty
-        if row["source_props"]:
-            props["source_props"] = json.loads(row["source_props"])
-        props_collection[key].append(props)
 
-    for placeholder in props_collection:
-        query = (
-            f"INSERT INTO "
-            f'"{project_id}"._source_ '
-            f"(start_id, end_id, properties) "
-            f"VALUES (:domain_id, :range_id, :properties) "
+async def import_plan(
+    pool: asyncpg.pool.Pool,
+    project_name: str,
+    username: str,
+    entity_confs: typing.List[typing.Dict],
+    relation_confs: typing.List[typing.Dict],
+    entity_source_confs: typing.List[typing.Dict] = None,
+    relation_source_confs: typing.List[typing.Dict] = None,
+    lookups: typing.Dict = None,
+    connections: int = 4,
+    consumers: int = 1,
+    workers: int = 0,
+    vertex_write_method: str = "copy",
+    edge_write_method: str = "copy",
+    lazy_lookups: bool = False,
+    resume: bool = False,
+    rejected_dir: str = None,
+    incremental_index: bool = False,
+):
+    """
+    Import a full set of entity, relation and source files.
+    Entity types are written to their own tables, so they are imported concurrently. A
+    relation import starts as soon as its domain and range entity types have been
+    imported, entity and relation sources once all entities, respectively relations,
+    have been imported. Every running import uses up to consumers + 1 connections, the
+    number of concurrent imports is limited so no more than `connections` are in use
+    (the pool should be at least that large). With workers > 0, all entity imports share
+    a single pool of that many worker processes.
+    With resume, every import records its progress in a checkpoint, so rerunning a
+    failed plan skips the finished imports and continues the others after their last
+    committed batch.
+    With rejected_dir, the rows with unresolved values of every relation and source file
+    are written to a csv file with the same name in that directory.
+    """
+    if entity_source_confs is None:
+        entity_source_confs = []
+    if relation_source_confs is None:
+        relation_source_confs = []
+    if lookups is None:
+        lookups = {}
+    slots = asyncio.Semaphore(max(1, connections // (consumers + 1)))
+    executor = None
+    if workers:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    # Lookups needed by the relations, per entity type
+    lookup_props: typing.Dict[str, typing.List[str]] = collections.defaultdict(list)
+    if not lazy_lookups:
+        for conf in relation_confs:
+            for (type_name, type_conf) in [
+                (conf["domain_type_name"], conf["domain"]),
+                (conf["range_type_name"], conf["range"]),
+            ]:
+                prop_name = list(type_conf.keys())[0]
+                if prop_name not in lookup_props[type_name]:
+                    lookup_props[type_name].append(prop_name)
+
+    # Entity types that are not part of the plan have been imported before
+    planned_types = [conf["entity_type_name"] for conf in entity_confs]
+    for (type_name, prop_names) in lookup_props.items():
+        if type_name in planned_types:
+            continue
+        for prop_name in prop_names:
+            if prop_name in lookups.get(type_name, {}):
+                continue
+            lookups.setdefault(type_name, {})[prop_name] = await create_lookup(
+                pool=pool,
+                project_name=project_name,
+                type_name=type_name,
+                prop_name=prop_name,
+                type="entity",
+            )
+
+    def rejected_filename(conf: typing.Dict) -> typing.Optional[str]:
+        if rejected_dir is None:
+            return None
+        return os.path.join(rejected_dir, conf["filename"])
+
+    async def run(
+        dependencies: typing.List[asyncio.Future],
+        method: typing.Callable,
+        **kwargs,
+    ):
+        # Only take a slot once the dependencies are ready, so waiting imports don't
+        # block the ones they are waiting for
+        await asyncio.gather(*dependencies)
+        async with slots:
+            await method(
+                pool=pool,
+                project_name=project_name,
+                username=username,
+                resume=resume,
+                **kwargs,
+            )
+
+    entity_tasks = {
+        conf["entity_type_name"]: asyncio.ensure_future(
+            run(
+                [],
+                import_entities,
+                conf=conf,
+                lookups=lookups,
+                lookup_props=lookup_props[conf["entity_type_name"]],
+                vertex_write_method=vertex_write_method,
+                consumers=consumers,
+                workers=workers,
+                incremental_index=incremental_index,
+                executor=executor,
+            )
         )
-        await db_base.executemany(
-            pool,
-            query,
-            [
-                {
-                    "domain_id": params["domain_id"],
-                    "range_id": params["range_id"],
-                    "properties": json.dumps(
-                        {
-                            k: params[k]
-                            for k in params
-                            if k not in ["domain_id", "range_id"]
-                        }
-                    ),
-                }
-                for params in props_collection[placeholder]
-            ],
-            True,
+        for conf in entity_confs
+    }
+    relation_tasks = [
+        asyncio.ensure_future(
+            run(
+                [
+                    entity_tasks[type_name]
+                    for type_name in {conf["domain_type_name"], conf["range_type_name"]}
+                    if type_name in entity_tasks
+                ],
+                import_relations,
+                conf=conf,
+                lookups=lookups,
+                edge_write_method=edge_write_method,
+                vertex_write_method=vertex_write_method,
+                consumers=consumers,
+                lazy_lookups=lazy_lookups,
+                rejected_filename=rejected_filename(conf),
+            )
         )
-
-    await db_base.execute(
-        pool,
-        """
-            UPDATE app.relation_count
-            SET current_id = :id
-            WHERE id = (
-                SELECT id FROM app.relation
-                WHERE project_id = :project_id
-                AND system_name = :relation_type_name
+        for conf in relation_confs
+    ]
+    # Source imports build their own id lookups
+    source_lookups: typing.Dict = {}
+    source_tasks = [
+        *[
+            asyncio.ensure_future(
+                run(
+                    list(entity_tasks.values()),
+                    import_entity_source_relations,
+                    conf=conf,
+                    lookups=source_lookups,
+                    edge_write_method=edge_write_method,
+                    consumers=consumers,
+                    rejected_filename=rejected_filename(conf),
+                )
             )
-        """,
-        {
-            "id": id,
-            "project_id": project_id,
-            "relation_type_name": "_source_",
-        },
-    )
+            for conf in entity_source_confs
+        ],
+        *[
+            asyncio.ensure_future(
+                run(
+                    [*entity_tasks.values(), *relation_tasks],
+                    import_relation_source_relations,
+                    conf=conf,
+                    lookups=source_lookups,
+                    edge_write_method=edge_write_method,
+                    consumers=consumers,
+                    rejected_filename=rejected_filename(conf),
+                )
+            )
+            for conf in relation_source_confs
+        ],
+    ]
+
+    tasks = [*entity_tasks.values(), *relation_tasks, *source_tasks]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
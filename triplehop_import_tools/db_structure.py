@@ -1,9 +1,9 @@
+import json
 import typing
 
-import aiocache
 import asyncpg
 
-from triplehop_import_tools import db_base
+from triplehop_import_tools import db_base, lookup_tables
 
 
 def read_config_from_file(type: str, system_name: str):
@@ -11,76 +11,138 @@ def read_config_from_file(type: str, system_name: str):
         return config_file.read()
 
 
-@aiocache.cached()
-async def get_project_id(pool: asyncpg.pool.Pool, project_name: str) -> str:
-    return await db_base.fetchval(
+def _props_lookup(data: typing.Optional[str]) -> typing.Dict[str, str]:
+    """Property system name -> id lookup from the data part of a type config."""
+    if data:
+        config = json.loads(data)
+        if "fields" in config:
+            return {v["system_name"]: k for (k, v) in config["fields"].items()}
+    return {}
+
+
+class ProjectCatalogue:
+    """
+    Metadata of a project: the ids and property lookups of all entity and relation
+    types, loaded with a single query. Accessors are synchronous dictionary lookups and
+    return None for unknown types, like the queries they replace.
+    """
+
+    def __init__(self, project_id: typing.Optional[str]):
+        self.project_id = project_id
+        self.entity_ids: typing.Dict[str, str] = {}
+        self.relation_ids: typing.Dict[str, str] = {}
+        self.entity_props: typing.Dict[str, typing.Dict[str, str]] = {}
+        self.relation_props: typing.Dict[str, typing.Dict[str, str]] = {}
+
+    def entity_type_id(self, entity_type_name: str) -> typing.Optional[str]:
+        return self.entity_ids.get(entity_type_name)
+
+    def relation_type_id(self, relation_type_name: str) -> typing.Optional[str]:
+        return self.relation_ids.get(relation_type_name)
+
+    def entity_props_lookup(self, entity_type_name: str) -> typing.Dict[str, str]:
+        return self.entity_props.get(entity_type_name, {})
+
+    def relation_props_lookup(self, relation_type_name: str) -> typing.Dict[str, str]:
+        return self.relation_props.get(relation_type_name, {})
+
+
+# project system name -> catalogue
+_catalogues: typing.Dict[str, ProjectCatalogue] = {}
+# username -> user id
+_user_ids: typing.Dict[str, str] = {}
+
+
+async def get_catalogue(pool: asyncpg.pool.Pool, project_name: str) -> ProjectCatalogue:
+    """
+    Get the metadata catalogue of a project, loading it if needed.
+    Catalogues are kept until they are invalidated by a config change.
+    """
+    if project_name in _catalogues:
+        return _catalogues[project_name]
+
+    records = await db_base.fetch(
         pool,
         """
-            SELECT project.id::text
+            SELECT project.id::text AS project_id, types.kind, types.id::text, types.system_name, types.data
             FROM app.project
+            LEFT JOIN (
+                SELECT 'entity' AS kind, id, project_id, system_name, config->'data' AS data
+                FROM app.entity
+                UNION ALL
+                SELECT 'relation' AS kind, id, project_id, system_name, config->'data' AS data
+                FROM app.relation
+            ) AS types
+                ON types.project_id = project.id
             WHERE project.system_name = :project_name;
         """,
         {
             "project_name": project_name,
         },
     )
+    if not records:
+        # Projects that don't exist (yet) aren't cached
+        return ProjectCatalogue(None)
+
+    catalogue = ProjectCatalogue(records[0]["project_id"])
+    for record in records:
+        if record["kind"] == "entity":
+            catalogue.entity_ids[record["system_name"]] = record["id"]
+            catalogue.entity_props[record["system_name"]] = _props_lookup(
+                record["data"]
+            )
+        elif record["kind"] == "relation":
+            catalogue.relation_ids[record["system_name"]] = record["id"]
+            catalogue.relation_props[record["system_name"]] = _props_lookup(
+                record["data"]
+            )
+    _catalogues[project_name] = catalogue
+    return catalogue
+
+
+def invalidate_catalogue(project_name: str = None) -> None:
+    """Drop the catalogue of a project (or of all projects) so it is reloaded."""
+    if project_name is None:
+        _catalogues.clear()
+    else:
+        _catalogues.pop(project_name, None)
+
+
+async def get_project_id(pool: asyncpg.pool.Pool, project_name: str) -> str:
+    return (await get_catalogue(pool, project_name)).project_id
 
 
-@aiocache.cached()
 async def get_entity_type_id(
     pool: asyncpg.pool.Pool, project_name: str, entity_type_name: str
 ) -> str:
-    return await db_base.fetchval(
-        pool,
-        """
-            SELECT entity.id::text
-            FROM app.entity
-            INNER JOIN app.project
-                ON entity.project_id = project.id
-            WHERE project.system_name = :project_name
-                AND entity.system_name = :entity_type_name;
-        """,
-        {
-            "project_name": project_name,
-            "entity_type_name": entity_type_name,
-        },
-    )
+    return (await get_catalogue(pool, project_name)).entity_type_id(entity_type_name)
 
 
-@aiocache.cached()
 async def get_relation_type_id(
     pool: asyncpg.pool.Pool, project_name: str, relation_type_name: str
 ) -> str:
-    return await db_base.fetchval(
-        pool,
-        """
-            SELECT relation.id::text
-            FROM app.relation
-            INNER JOIN app.project
-                ON relation.project_id = project.id
-            WHERE project.system_name = :project_name
-                AND relation.system_name = :relation_type_name;
-        """,
-        {
-            "project_name": project_name,
-            "relation_type_name": relation_type_name,
-        },
+    return (await get_catalogue(pool, project_name)).relation_type_id(
+        relation_type_name
     )
 
 
-@aiocache.cached()
 async def get_user_id(pool: asyncpg.pool.Pool, username: str) -> str:
-    return await db_base.fetchval(
-        pool,
-        """
-            SELECT "user".id
-            FROM app.user
-            WHERE "user".username = :username;
-        """,
-        {
-            "username": username,
-        },
-    )
+    if username not in _user_ids:
+        user_id = await db_base.fetchval(
+            pool,
+            """
+                SELECT "user".id
+                FROM app.user
+                WHERE "user".username = :username;
+            """,
+            {
+                "username": username,
+            },
+        )
+        if user_id is None:
+            return None
+        _user_ids[username] = user_id
+    return _user_ids[username]
 
 
 async def create_project_config(
@@ -106,57 +168,62 @@ async def create_project_config(
             "username": username,
         },
     )
+    invalidate_catalogue(system_name)
 
 
-async def create_entity_config(
-    pool: asyncpg.pool.Pool,
-    project_name: str,
-    username: str,
-    system_name: str,
-    display_name: str,
-    config: typing.Dict,
-    reset_count: bool = True,
-):
-    await db_base.execute(
-        pool,
-        """
-            INSERT INTO app.entity (project_id, system_name, display_name, config, user_id)
-            VALUES (
-                (SELECT project.id FROM app.project WHERE system_name = :project_name),
-                :system_name,
-                :display_name,
-                :config,
-                (SELECT "user".id FROM app.user WHERE "user".username = :username)
+def _config_text(config: typing.Union[str, typing.Dict]) -> str:
+    if isinstance(config, str):
+        return config
+    return json.dumps(config)
+
+
+async def _sync_types(
+    tx: db_base.Transaction,
+    table: str,
+    project_id: str,
+    user_id: str,
+    configs: typing.List[typing.Dict],
+    reset_count: bool,
+) -> None:
+    """
+    Upsert the entity or relation types of a project (table is entity or relation) and
+    write a revision for every type that was created or of which the config changed.
+    """
+    await tx.execute(
+        f"""
+            WITH input AS (
+                SELECT *
+                FROM unnest(:system_names::text[], :display_names::text[], :configs::text[])
+                    AS input (system_name, display_name, config)
+            ),
+            changed AS (
+                INSERT INTO app.{table} (project_id, system_name, display_name, config, user_id)
+                SELECT :project_id::uuid, system_name, display_name, config::json, :user_id::uuid
+                FROM input
+                ON CONFLICT (project_id, system_name) DO UPDATE
+                SET config = EXCLUDED.config
+                WHERE {table}.config::jsonb IS DISTINCT FROM EXCLUDED.config::jsonb
+                RETURNING id, project_id, system_name, display_name, config, user_id
             )
-            ON CONFLICT (project_id, system_name) DO UPDATE
-            SET config = EXCLUDED.config;
-        """,
-        {
-            "project_name": project_name,
-            "system_name": system_name,
-            "display_name": display_name,
-            "config": config,
-            "username": username,
-        },
-    )
-    await db_base.execute(
-        pool,
-        """
-            INSERT INTO app.entity_revision (entity_id, project_id, system_name, display_name, config, user_id)
+            INSERT INTO app.{table}_revision ({table}_id, project_id, system_name, display_name, config, user_id)
             SELECT id, project_id, system_name, display_name, config, user_id
-            FROM app.entity
-            WHERE system_name = :system_name;
+            FROM changed;
         """,
         {
-            "system_name": system_name,
+            "project_id": project_id,
+            "user_id": user_id,
+            "system_names": [c["system_name"] for c in configs],
+            "display_names": [c["display_name"] for c in configs],
+            "configs": [_config_text(c["config"]) for c in configs],
         },
     )
     query = \
-        """
-            INSERT INTO app.entity_count (id)
-            VALUES (
-                (SELECT entity.id FROM app.entity WHERE system_name = :system_name)
-            )
+        f"""
+            INSERT INTO app.{table}_count (id)
+            SELECT id
+            FROM app.{table}
+            WHERE project_id = :project_id
+                AND system_name = ANY(:system_names::text[])
         """
     if reset_count:
         query += \
@@ -169,199 +236,163 @@ async def create_entity_config(
             """
                 ON CONFLICT (id) DO NOTHING;
             """
-    await db_base.execute(
-        pool,
+    await tx.execute(
         query,
         {
-            "system_name": system_name,
+            "project_id": project_id,
+            "system_names": [c["system_name"] for c in configs],
         },
     )
 
 
-async def create_relation_config(
+async def _sync_relation_entities(
+    tx: db_base.Transaction,
+    table: str,
+    key: str,
+    project_id: str,
+    user_id: str,
+    relation_configs: typing.List[typing.Dict],
+) -> None:
+    """
+    Make the domains or ranges (table is relation_domain or relation_range, key domains
+    or ranges) of the given relation types match their configs, only touching rows that
+    were added or removed.
+    """
+    params = {
+        "project_id": project_id,
+        "user_id": user_id,
+        "relation_names": [c["system_name"] for c in relation_configs],
+        "pair_relations": [c["system_name"] for c in relation_configs for _ in c[key]],
+        "pair_entities": [e for c in relation_configs for e in c[key]],
+    }
+    await tx.execute(
+        f"""
+            DELETE FROM app.{table}
+            USING app.relation
+            WHERE {table}.relation_id = relation.id
+                AND relation.project_id = :project_id
+                AND relation.system_name = ANY(:relation_names::text[])
+                AND NOT EXISTS (
+                    SELECT
+                    FROM unnest(:pair_relations::text[], :pair_entities::text[])
+                        AS pair (relation_name, entity_name)
+                    INNER JOIN app.entity
+                        ON entity.project_id = :project_id
+                        AND entity.system_name = pair.entity_name
+                    WHERE pair.relation_name = relation.system_name
+                        AND entity.id = {table}.entity_id
+                );
+        """,
+        params,
+    )
+    await tx.execute(
+        f"""
+            INSERT INTO app.{table} (relation_id, entity_id, user_id)
+            SELECT relation.id, entity.id, :user_id::uuid
+            FROM unnest(:pair_relations::text[], :pair_entities::text[])
+                AS pair (relation_name, entity_name)
+            INNER JOIN app.relation
+                ON relation.project_id = :project_id
+                AND relation.system_name = pair.relation_name
+            INNER JOIN app.entity
+                ON entity.project_id = :project_id
+                AND entity.system_name = pair.entity_name
+            ON CONFLICT DO NOTHING;
+        """,
+        params,
+    )
+
+
+async def sync_project_config(
+    pool: asyncpg.pool.Pool,
+    project_name: str,
+    username: str,
+    entity_configs: typing.List[typing.Dict],
+    relation_configs: typing.List[typing.Dict],
+    reset_count: bool = True,
+):
+    """
+    Synchronise the entity and relation type configs of a project in one transaction.
+    Entity configs have a system_name, display_name and config, relation configs also
+    have lists of domain and range entity type names (domains and ranges). Types are
+    upserted with a couple of set-based statements; revisions are only written for types
+    that are new or of which the config changed. Types that are not part of the configs
+    are left untouched.
+    """
+    project_id = await get_project_id(pool, project_name)
+    user_id = await get_user_id(pool, username)
+
+    async def work(tx: db_base.Transaction) -> None:
+        if entity_configs:
+            await _sync_types(
+                tx, "entity", project_id, user_id, entity_configs, reset_count
+            )
+        if relation_configs:
+            await _sync_types(
+                tx, "relation", project_id, user_id, relation_configs, reset_count
+            )
+            await _sync_relation_entities(
+                tx, "relation_domain", "domains", project_id, user_id, relation_configs
+            )
+            await _sync_relation_entities(
+                tx, "relation_range", "ranges", project_id, user_id, relation_configs
+            )
+
+    await db_base.transaction(pool, work)
+    invalidate_catalogue(project_name)
+
+
+async def create_entity_config(
     pool: asyncpg.pool.Pool,
     project_name: str,
     username: str,
     system_name: str,
     display_name: str,
     config: typing.Dict,
-    domains: typing.List,
-    ranges: typing.List,
     reset_count: bool = True,
 ):
-    await db_base.execute(
-        pool,
-        """
-            INSERT INTO app.relation (project_id, system_name, display_name, config, user_id)
-            VALUES (
-                (SELECT project.id FROM app.project WHERE system_name = :project_name),
-                :system_name,
-                :display_name,
-                :config,
-                (SELECT "user".id FROM app.user WHERE "user".username = :username)
-            )
-            ON CONFLICT (project_id, system_name) DO UPDATE
-            SET config = EXCLUDED.config;
-        """,
-        {
-            "project_name": project_name,
-            "system_name": system_name,
-            "display_name": display_name,
-            "config": config,
-            "username": username,
-        },
-    )
-    # TODO: revisions
-    # Remove all previously configured domains
-    await db_base.execute(
+    await sync_project_config(
         pool,
-        """
-            DELETE FROM app.relation_domain
-            WHERE relation_id = (
-                SELECT relation.id
-                FROM app.relation
-                WHERE project_id = (
-                    SELECT project.id
-                    FROM app.project
-                    WHERE system_name = :project_name
-                )
-                AND system_name = :relation_name
-            );
-        """,
-        {
-            "project_name": project_name,
-            "relation_name": system_name,
-        },
-    )
-    for entity_type_name in domains:
-        await db_base.execute(
-            pool,
-            """
-                INSERT INTO app.relation_domain (relation_id, entity_id, user_id)
-                VALUES (
-                    (
-                        SELECT relation.id
-                        FROM app.relation
-                        WHERE project_id = (
-                            SELECT project.id
-                            FROM app.project
-                            WHERE system_name = :project_name
-                        )
-                        AND system_name = :relation_name
-                    ),
-                    (SELECT entity.id FROM app.entity WHERE system_name = :entity_type_name),
-                    (SELECT "user".id FROM app.user WHERE "user".username = :username)
-                )
-                ON CONFLICT DO NOTHING;
-            """,
+        project_name,
+        username,
+        [
             {
-                "project_name": project_name,
-                "relation_name": system_name,
-                "entity_type_name": entity_type_name,
-                "username": username,
+                "system_name": system_name,
+                "display_name": display_name,
+                "config": config,
             },
-        )
-    # Remove all previously configured ranges
-    await db_base.execute(
-        pool,
-        """
-            DELETE FROM app.relation_range
-            WHERE relation_id = (
-                SELECT relation.id
-                FROM app.relation
-                WHERE project_id = (
-                    SELECT project.id
-                    FROM app.project
-                    WHERE system_name = :project_name
-                )
-                AND system_name = :relation_name
-            );
-        """,
-        {
-            "project_name": project_name,
-            "relation_name": system_name,
-        },
+        ],
+        [],
+        reset_count,
     )
-    for entity_type_name in ranges:
-        await db_base.execute(
-            pool,
-            """
-                INSERT INTO app.relation_range (relation_id, entity_id, user_id)
-                VALUES (
-                    (
-                        SELECT relation.id
-                        FROM app.relation
-                        WHERE project_id = (
-                            SELECT project.id
-                            FROM app.project
-                            WHERE system_name = :project_name
-                        )
-                        AND system_name = :relation_name
-                    ),
-                    (SELECT entity.id FROM app.entity WHERE system_name = :entity_type_name),
-                    (SELECT "user".id FROM app.user WHERE "user".username = :username)
-                )
-                ON CONFLICT DO NOTHING;
-            """,
+
+
+async def create_relation_config(
+    pool: asyncpg.pool.Pool,
+    project_name: str,
+    username: str,
+    system_name: str,
+    display_name: str,
+    config: typing.Dict,
+    domains: typing.List,
+    ranges: typing.List,
+    reset_count: bool = True,
+):
+    await sync_project_config(
+        pool,
+        project_name,
+        username,
+        [],
+        [
             {
-                "project_name": project_name,
-                "relation_name": system_name,
-                "entity_type_name": entity_type_name,
-                "username": username,
+                "system_name": system_name,
+                "display_name": display_name,
+                "config": config,
+                "domains": domains,
+                "ranges": ranges,
             },
-        )
-    await db_base.execute(
-        pool,
-        """
-            INSERT INTO app.relation_revision (relation_id, project_id, system_name, display_name, config, user_id)
-            SELECT id, project_id, system_name, display_name, config, user_id
-            FROM app.relation
-            WHERE project_id = (
-                SELECT project.id
-                FROM app.project
-                WHERE system_name = :project_name
-            )
-            AND system_name = :relation_name
-        """,
-        {
-            "project_name": project_name,
-            "relation_name": system_name,
-        },
-    )
-    query = \
-        """
-            INSERT INTO app.relation_count (id)
-            VALUES (
-                (
-                    SELECT relation.id
-                    FROM app.relation
-                        WHERE project_id = (
-                        SELECT project.id
-                        FROM app.project
-                        WHERE system_name = :project_name
-                    )
-                    AND system_name = :relation_name
-                )
-            )
-        """
-    if reset_count:
-        query += \
-            """
-                ON CONFLICT (id) DO UPDATE
-                SET current_id = 0;
-            """
-    else:
-        query += \
-            """
-                ON CONFLICT (id) DO NOTHING;
-            """
-    await db_base.execute(
-        pool,
-        query,
-        {
-            "project_name": project_name,
-            "relation_name": system_name,
-        },
+        ],
+        reset_count,
     )
 
 
@@ -403,96 +434,120 @@ async def drop_project_graph(pool: asyncpg.pool.Pool, project_name: str):
         pass
     except asyncpg.exceptions.UndefinedTableError:
         pass
-
-
-async def create_project_graph(pool: asyncpg.pool.Pool, project_name: str):
-    project_id = await get_project_id(pool, project_name)
+    # Import checkpoints refer to the dropped data
     await db_base.execute(
         pool,
         """
-            SELECT create_graph(:project_id);
-        """,
-        {
-            "project_id": project_id,
-        },
-        True,
-    )
-
-    # Make sure vlabels and elabels exist
-    # Entity types
-    records = await db_base.fetch(
-        pool,
-        """
-            SELECT id
-            FROM app.entity
+            DELETE FROM app.job
             WHERE project_id = :project_id
+                AND type LIKE 'import\\_%';
         """,
         {
             "project_id": project_id,
         },
-        True,
     )
-    for record in records:
-        await db_base.execute(
-            pool,
+    # As do cached lookups, the fingerprint of a recreated graph can match them
+    lookup_tables.clear_lookups(project_id)
+
+
+async def create_project_graph(pool: asyncpg.pool.Pool, project_name: str):
+    """
+    Create the graph of a project with a label for every entity and relation type.
+    All labels are created in a single transaction and only missing ones are created,
+    so running it again for an existing graph is cheap.
+    """
+    project_id = await get_project_id(pool, project_name)
+
+    async def work(tx: db_base.Transaction) -> None:
+        graph_exists = await tx.fetchval(
             """
-                SELECT create_vlabel(:project_id, :label);
+                SELECT EXISTS (
+                    SELECT FROM ag_catalog.ag_graph WHERE name = :project_id
+                );
             """,
             {
                 "project_id": project_id,
-                "label": f'n_{db_base.dtu(str(record["id"]))}',
             },
-            True,
         )
-    # Relation types
-    records = await db_base.fetch(
-        pool,
-        """
-            SELECT id
-            FROM app.relation
-            WHERE project_id = :project_id
-        """,
-        {
-            "project_id": project_id,
-        },
-        True,
-    )
-    for record in records:
-        await db_base.execute(
-            pool,
+        if not graph_exists:
+            await tx.execute(
+                """
+                    SELECT create_graph(:project_id);
+                """,
+                {
+                    "project_id": project_id,
+                },
+            )
+
+        existing = {
+            record["name"]
+            for record in await tx.fetch(
+                """
+                    SELECT ag_label.name::text
+                    FROM ag_catalog.ag_label
+                    INNER JOIN ag_catalog.ag_graph
+                        ON ag_label.graph = ag_graph.graphid
+                    WHERE ag_graph.name = :project_id;
+                """,
+                {
+                    "project_id": project_id,
+                },
+            )
+        }
+
+        # Make sure vlabels and elabels exist
+        vlabels = []
+        elabels = []
+        # Entity types
+        records = await tx.fetch(
             """
-                SELECT create_elabel(:project_id, :label);
+                SELECT id
+                FROM app.entity
+                WHERE project_id = :project_id
             """,
             {
                 "project_id": project_id,
-                "label": f'e_{db_base.dtu(str(record["id"]))}',
             },
-            True,
         )
-        # Relation nodes used to add sources
-        await db_base.execute(
-            pool,
+        for record in records:
+            vlabels.append(f'n_{db_base.dtu(str(record["id"]))}')
+        # Relation types
+        records = await tx.fetch(
             """
-                SELECT create_vlabel(:project_id, :label);
+                SELECT id
+                FROM app.relation
+                WHERE project_id = :project_id
             """,
             {
                 "project_id": project_id,
-                "label": f'en_{db_base.dtu(str(record["id"]))}',
             },
-            True,
         )
-    # Sources
-    await db_base.execute(
-        pool,
-        """
-            SELECT create_elabel(:project_id, :label);
-        """,
-        {
-            "project_id": project_id,
-            "label": "_source_",
-        },
-        True,
-    )
+        for record in records:
+            elabels.append(f'e_{db_base.dtu(str(record["id"]))}')
+            # Relation nodes used to add sources
+            vlabels.append(f'en_{db_base.dtu(str(record["id"]))}')
+        # Sources
+        elabels.append("_source_")
+
+        for (function, labels) in [
+            ("create_vlabel", vlabels),
+            ("create_elabel", elabels),
+        ]:
+            labels = [label for label in labels if label not in existing]
+            if not labels:
+                continue
+            await tx.execute(
+                f"""
+                    SELECT {function}(:project_id::text::cstring, label::cstring)
+                    FROM unnest(:labels::text[]) AS label;
+                """,
+                {
+                    "project_id": project_id,
+                    "labels": labels,
+                },
+            )
+
+    await db_base.transaction(pool, work, True)
 
     # Revisions
     await db_base.execute(
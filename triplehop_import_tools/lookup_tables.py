@@ -0,0 +1,166 @@
+import array
+import bisect
+import collections.abc
+import glob
+import mmap
+import os
+import typing
+
+CACHE_DIR = ".cache"
+
+
+class IntLookup(collections.abc.Mapping):
+    """
+    Read-only mapping from integer property values to graphids.
+    Keys and graphids are stored in two sorted array('q') columns and looked up with a
+    binary search, which takes 16 bytes per vertex instead of a dict entry with an int
+    and a str object. Graphids are returned as str, like in dict based lookups.
+    """
+
+    def __init__(self, keys: typing.Sequence[int], values: typing.Sequence[int]):
+        self.key_column = keys
+        self.value_column = values
+
+    @classmethod
+    def from_pairs(cls, pairs: typing.Iterable[typing.Tuple[int, int]]) -> "IntLookup":
+        """
+        Create a lookup from (key, graphid) pairs. Like in a dict, the last graphid of a
+        key that occurs multiple times is kept.
+        """
+        keys = array.array("q")
+        values = array.array("q")
+        for (key, value) in pairs:
+            keys.append(key)
+            values.append(value)
+        return cls._sorted(keys, values)
+
+    @classmethod
+    def _sorted(cls, keys: array.array, values: array.array) -> "IntLookup":
+        if all(keys[i] < keys[i + 1] for i in range(len(keys) - 1)):
+            return cls(keys, values)
+        # Sort positions instead of pairs, which takes less memory. The sort is stable,
+        # so the last position of a key comes last.
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        sorted_keys = array.array("q")
+        sorted_values = array.array("q")
+        for (i, position) in enumerate(order):
+            if i + 1 < len(order) and keys[order[i + 1]] == keys[position]:
+                continue
+            sorted_keys.append(keys[position])
+            sorted_values.append(values[position])
+        return cls(sorted_keys, sorted_values)
+
+    def _index(self, key: typing.Any) -> int:
+        if not isinstance(key, int) or isinstance(key, bool):
+            return -1
+        i = bisect.bisect_left(self.key_column, key)
+        if i != len(self.key_column) and self.key_column[i] == key:
+            return i
+        return -1
+
+    def __getitem__(self, key: typing.Any) -> str:
+        i = self._index(key)
+        if i == -1:
+            raise KeyError(key)
+        return str(self.value_column[i])
+
+    def __contains__(self, key: typing.Any) -> bool:
+        return self._index(key) != -1
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self.key_column)
+
+    def __len__(self) -> int:
+        return len(self.key_column)
+
+
+def build_lookup(
+    pairs: typing.Iterable[typing.Tuple[typing.Any, str]]
+) -> typing.Mapping[typing.Any, str]:
+    """
+    Create a lookup from (property value, graphid) pairs, which are consumed once.
+    If all property values are integers, a compact IntLookup is returned, otherwise a dict.
+    In both cases, the last graphid of a property value that occurs multiple times is
+    kept.
+    """
+    keys = array.array("q")
+    values = array.array("q")
+    iterator = iter(pairs)
+    for (k, v) in iterator:
+        if not isinstance(k, int) or isinstance(k, bool):
+            # Continue with a dict, starting with the pairs seen so far
+            lookup = {key: str(value) for (key, value) in zip(keys, values)}
+            lookup[k] = v
+            lookup.update(iterator)
+            return lookup
+        keys.append(k)
+        values.append(int(v))
+    return IntLookup._sorted(keys, values)
+
+
+def _cache_path(
+    project_id: str,
+    label: str,
+    key: str,
+    fingerprint: typing.Tuple[int, ...],
+) -> str:
+    return os.path.join(
+        CACHE_DIR,
+        f"{project_id}_{label}_{key}_{'_'.join(str(f) for f in fingerprint)}.lookup",
+    )
+
+
+def load_lookup(
+    project_id: str,
+    label: str,
+    key: str,
+    fingerprint: typing.Tuple[int, ...],
+) -> typing.Optional[IntLookup]:
+    """
+    Load a lookup from the on-disk cache, if it was saved for the same graph state.
+    The file is memory-mapped, so only the pages visited by the binary search are read.
+    """
+    path = _cache_path(project_id, label, key, fingerprint)
+    if not os.path.exists(path):
+        return None
+    if os.path.getsize(path) == 0:
+        return IntLookup(array.array("q"), array.array("q"))
+    with open(path, "rb") as f:
+        # The memory map stays valid after the file has been closed
+        memory_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    columns = memoryview(memory_map).cast("q")
+    length = len(columns) // 2
+    return IntLookup(columns[:length], columns[length:])
+
+
+def save_lookup(
+    project_id: str,
+    label: str,
+    key: str,
+    fingerprint: typing.Tuple[int, ...],
+    lookup: typing.Mapping,
+) -> None:
+    """
+    Save a lookup to the on-disk cache and remove the files of previous graph states.
+    Only IntLookups are cached.
+    """
+    if not isinstance(lookup, IntLookup):
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for stale_path in glob.glob(
+        os.path.join(
+            CACHE_DIR, f"{glob.escape(f'{project_id}_{label}_{key}_')}*.lookup"
+        )
+    ):
+        os.remove(stale_path)
+    path = _cache_path(project_id, label, key, fingerprint)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(lookup.key_column.tobytes())
+        f.write(lookup.value_column.tobytes())
+    os.replace(f"{path}.tmp", path)
+
+
+def clear_lookups(project_id: str) -> None:
+    """Remove all cached lookups of a project."""
+    for path in glob.glob(os.path.join(CACHE_DIR, f"{glob.escape(project_id)}_*")):
+        os.remove(path)
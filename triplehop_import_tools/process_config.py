@@ -1,10 +1,15 @@
+import argparse
+import concurrent.futures
 import copy
+import hashlib
 import json
 import os
 import re
 import typing
 import uuid
 
+import ujson
+
 RE_FIELD_CONVERSION = re.compile(
     (
         # zero, one or multiple (inverse) relations
@@ -178,11 +183,26 @@ def replace_group(project_config: dict, name: str) -> str:
     return project_config["groups_base"][project_name][group_name]["id"]
 
 
-def process() -> None:
-    project_config: typing.Dict[str, typing.Dict] = {
-        "entity": {},
-        "relation": {},
-    }
+CONFIG_PARTS = [
+    "detail",
+    "source",
+    "data",
+    "display",
+    "edit",
+    "es_data",
+    "es_display",
+    "style",
+]
+BASE_FILES = ["entities.json", "relations.json", "groups.json"]
+MANIFEST = "config/.manifest.json"
+RE_RELATION_REFERENCE = re.compile(r"[$]ri?_([a-z_]+)")
+# Minimal number of configs to render before a pool of worker processes is used:
+# starting the workers and sending them the project config takes longer than rendering
+# a few configs
+POOL_MIN_CONFIGS = 50
+
+
+def load_base_config(project_config: dict) -> None:
     # Load entities config: ids might be needed when replacing
     if os.path.exists(f"human_readable_config/entities.json"):
         with open(f"human_readable_config/entities.json") as f:
@@ -197,184 +217,386 @@ def process() -> None:
     if os.path.exists(f"human_readable_config/groups.json"):
         with open(f"human_readable_config/groups.json") as f:
             project_config["groups_base"] = json.load(f)
-    # first iteration: detail, source, data, style
+
+
+class ConfigFile:
+    # A human readable config together with its previously processed version.
+    # Both are read and parsed at most once.
+
+    def __init__(self, er: str, name: str, fn: str):
+        self.er = er
+        self.name = name
+        self.key = f"{er}/{name}"
+        with open(f"human_readable_config/{er}/{fn}") as f:
+            self.content = f.read()
+        self.hash = hashlib.sha256(self.content.encode()).hexdigest()
+        self._config: typing.Optional[dict] = None
+        self._output_text: typing.Optional[str] = None
+        self._output_read = False
+
+    @property
+    def config(self) -> dict:
+        if self._config is None:
+            self._config = ujson.loads(self.content)
+        return self._config
+
+    @property
+    def output_text(self) -> typing.Optional[str]:
+        if not self._output_read:
+            if os.path.exists(f"config/{self.key}.json"):
+                with open(f"config/{self.key}.json") as f:
+                    self._output_text = f.read()
+            self._output_read = True
+        return self._output_text
+
+    @property
+    def output_lookup(self) -> typing.Optional[typing.Dict[str, str]]:
+        # Property lookup of the previously processed config
+        if self.output_text is None:
+            return None
+        prev_config = ujson.loads(self.output_text)
+        if "data" not in prev_config:
+            return None
+        lookup = {
+            "id": "id",
+        }
+        if "fields" in prev_config["data"]:
+            for field in prev_config["data"]["fields"]:
+                lookup[prev_config["data"]["fields"][field]["system_name"]] = field
+        return lookup
+
+
+def load_config_files() -> typing.Dict[str, ConfigFile]:
+    config_files = {}
     for er in ["entity", "relation"]:
         for fn in os.listdir(f"human_readable_config/{er}"):
-            name = fn.split(".")[0]
-            project_config[er][name] = {}
-            prev_field_lookup = {}
-            with open(f"human_readable_config/{er}/{fn}") as f:
-                config = json.load(f)
-            # Store previously used uuids so they don't change
-            if os.path.exists(f"config/{er}/{fn}"):
-                with open(f"config/{er}/{fn}") as f:
-                    prev_config = json.load(f)
-                    if "data" in prev_config and "fields" in prev_config["data"]:
-                        for field in prev_config["data"]["fields"]:
-                            prev_field_lookup[
-                                prev_config["data"]["fields"][field]["system_name"]
-                            ] = field
-            if "detail" in config:
-                project_config[er][name]["detail"] = config["detail"]
-            if "source" in config:
-                project_config[er][name]["source"] = config["source"]
-            if "data" in config:
-                project_config[er][name]["data"] = {
-                    "fields": {},
-                    "permissions": {},
-                }
-                project_config[er][name]["lookup"] = {
-                    "id": "id",
-                }
-                if "fields" in config["data"]:
-                    for field in config["data"]["fields"]:
-                        if field["system_name"] in prev_field_lookup:
-                            id = prev_field_lookup[field["system_name"]]
-                        else:
-                            id = str(uuid.uuid4())
-                        if "permissions" in field:
-                            for permission, groups in field["permissions"].items():
-                                field["permissions"][permission] = [
-                                    replace_group(project_config, group)
-                                    for group in groups
-                                ]
-                        project_config[er][name]["data"]["fields"][id] = field
-                        project_config[er][name]["lookup"][field["system_name"]] = id
-                if "permissions" in config["data"]:
-                    for permission, groups in config["data"]["permissions"].items():
-                        project_config[er][name]["data"]["permissions"][permission] = [
+            config_file = ConfigFile(er, fn.split(".")[0], fn)
+            config_files[config_file.key] = config_file
+    return config_files
+
+
+# first iteration: detail, source, data, style
+def process_base(
+    project_config: dict,
+    er: str,
+    name: str,
+    config: dict,
+    prev_lookup: typing.Optional[typing.Dict[str, str]],
+) -> None:
+    project_config[er][name] = {}
+    prev_field_lookup = {}
+    # Store previously used uuids so they don't change
+    if prev_lookup is not None:
+        prev_field_lookup = {k: v for (k, v) in prev_lookup.items() if k != "id"}
+    if "detail" in config:
+        project_config[er][name]["detail"] = config["detail"]
+    if "source" in config:
+        project_config[er][name]["source"] = config["source"]
+    if "data" in config:
+        project_config[er][name]["data"] = {
+            "fields": {},
+            "permissions": {},
+        }
+        project_config[er][name]["lookup"] = {
+            "id": "id",
+        }
+        if "fields" in config["data"]:
+            for field in config["data"]["fields"]:
+                if field["system_name"] in prev_field_lookup:
+                    id = prev_field_lookup[field["system_name"]]
+                else:
+                    id = str(uuid.uuid4())
+                if "permissions" in field:
+                    for permission, groups in field["permissions"].items():
+                        field["permissions"][permission] = [
                             replace_group(project_config, group) for group in groups
                         ]
-            if "style" in config:
-                project_config[er][name]["style"] = config["style"]
+                project_config[er][name]["data"]["fields"][id] = field
+                project_config[er][name]["lookup"][field["system_name"]] = id
+        if "permissions" in config["data"]:
+            for permission, groups in config["data"]["permissions"].items():
+                project_config[er][name]["data"]["permissions"][permission] = [
+                    replace_group(project_config, group) for group in groups
+                ]
+    if "style" in config:
+        project_config[er][name]["style"] = config["style"]
+
+
+# second iteraton: display, edit
+def process_display(project_config: dict, er: str, name: str, config: dict) -> None:
+    if "display" in config:
+        project_config[er][name]["display"] = copy.deepcopy(config["display"])
+        display = project_config[er][name]["display"]
+        if "title" in display:
+            display["title"] = replace(project_config, er, name, display["title"])
+        if "layout" in display:
+            # TODO: add uuid to layout?
+            for layout in display["layout"]:
+                if "label" in layout:
+                    layout["label"] = replace(project_config, er, name, layout["label"])
+                if "fields" in layout:
+                    for field in layout["fields"]:
+                        field["field"] = replace(
+                            project_config, er, name, field["field"]
+                        )
+                        if "show_condition" in field:
+                            field["show_condition"] = replace_system_name(
+                                project_config, field["show_condition"]
+                            )
+    if "edit" in config:
+        project_config[er][name]["edit"] = copy.deepcopy(config["edit"])
+        edit = project_config[er][name]["edit"]
+        if "layout" in edit:
+            for layout in edit["layout"]:
+                if "label" in layout:
+                    layout["label"] = replace(project_config, er, name, layout["label"])
+                if "fields" in layout:
+                    for field in layout["fields"]:
+                        field["field"] = replace(
+                            project_config, er, name, field["field"]
+                        )
 
-    if "relations_base" in project_config:
-        # second iteraton: display, edit
-        for er in ["entity", "relation"]:
-            for fn in os.listdir(f"human_readable_config/{er}"):
-                name = fn.split(".")[0]
-                with open(f"human_readable_config/{er}/{fn}") as f:
-                    config = json.load(f)
-                if "display" in config:
-                    project_config[er][name]["display"] = copy.deepcopy(
-                        config["display"]
-                    )
-                    display = project_config[er][name]["display"]
-                    if "title" in display:
-                        display["title"] = replace(
-                            project_config, er, name, display["title"]
+
+# third iteration: es_data, es_display
+def process_es(project_config: dict, er: str, name: str, config: dict) -> None:
+    if "es_data" in config:
+        project_config[er][name]["es_data"] = copy.deepcopy(config["es_data"])
+        es_data = project_config[er][name]["es_data"]
+        if "fields" in es_data:
+            for field in es_data["fields"]:
+                if "base" in field:
+                    base = field["base"]
+                else:
+                    base = None
+
+                if (
+                    field["type"] == "nested"
+                    or field["type"] == "nested_multi_type"
+                    or field["type"] == "nested_flatten"
+                ):
+                    for key in field["parts"]:
+                        field["parts"][key] = replace(
+                            project_config,
+                            er,
+                            name,
+                            field["parts"][key],
+                            base,
                         )
-                    if "layout" in display:
-                        # TODO: add uuid to layout?
-                        for layout in display["layout"]:
-                            if "label" in layout:
-                                layout["label"] = replace(
-                                    project_config, er, name, layout["label"]
-                                )
-                            if "fields" in layout:
-                                for field in layout["fields"]:
-                                    field["field"] = replace(
-                                        project_config, er, name, field["field"]
-                                    )
-                                    if "show_condition" in field:
-                                        field["show_condition"] = replace_system_name(
-                                            project_config, field["show_condition"]
-                                        )
-                if "edit" in config:
-                    project_config[er][name]["edit"] = copy.deepcopy(config["edit"])
-                    edit = project_config[er][name]["edit"]
-                    if "layout" in edit:
-                        for layout in edit["layout"]:
-                            if "label" in layout:
-                                layout["label"] = replace(
-                                    project_config, er, name, layout["label"]
-                                )
-                            if "fields" in layout:
-                                for field in layout["fields"]:
-                                    field["field"] = replace(
-                                        project_config, er, name, field["field"]
-                                    )
-
-        # third iteration: es_data, es_display
-        for er in ["entity", "relation"]:
-            for fn in os.listdir(f"human_readable_config/{er}"):
-                name = fn.split(".")[0]
-                with open(f"human_readable_config/{er}/{fn}") as f:
-                    config = json.load(f)
-                if "es_data" in config:
-                    project_config[er][name]["es_data"] = copy.deepcopy(
-                        config["es_data"]
+                    field["base"] = replace(project_config, er, name, field["base"])
+                elif field["type"] == "edtf_interval":
+                    field["start"] = replace(project_config, er, name, field["start"])
+                    field["end"] = replace(project_config, er, name, field["end"])
+                else:
+                    field["selector_value"] = replace(
+                        project_config, er, name, field["selector_value"]
                     )
-                    es_data = project_config[er][name]["es_data"]
-                    if "fields" in es_data:
-                        for field in es_data["fields"]:
-                            if "base" in field:
-                                base = field["base"]
-                            else:
-                                base = None
-
-                            if (
-                                field["type"] == "nested"
-                                or field["type"] == "nested_multi_type"
-                                or field["type"] == "nested_flatten"
-                            ):
-                                for key in field["parts"]:
-                                    field["parts"][key] = replace(
-                                        project_config,
-                                        er,
-                                        name,
-                                        field["parts"][key],
-                                        base,
-                                    )
-                                field["base"] = replace(
-                                    project_config, er, name, field["base"]
-                                )
-                            elif field["type"] == "edtf_interval":
-                                field["start"] = replace(
-                                    project_config, er, name, field["start"]
-                                )
-                                field["end"] = replace(
-                                    project_config, er, name, field["end"]
-                                )
-                            else:
-                                field["selector_value"] = replace(
-                                    project_config, er, name, field["selector_value"]
-                                )
-                            if "filter" in field:
-                                field["filter"] = replace(
-                                    project_config, er, name, field["filter"], base
-                                )
-                    if "permissions" in es_data:
-                        for permission, groups in es_data["permissions"].items():
-                            es_data["permissions"][permission] = [
-                                replace_group(project_config, group) for group in groups
-                            ]
-                if "es_display" in config:
-                    project_config[er][name]["es_display"] = copy.deepcopy(
-                        config["es_display"]
+                if "filter" in field:
+                    field["filter"] = replace(
+                        project_config, er, name, field["filter"], base
                     )
+        if "permissions" in es_data:
+            for permission, groups in es_data["permissions"].items():
+                es_data["permissions"][permission] = [
+                    replace_group(project_config, group) for group in groups
+                ]
+    if "es_display" in config:
+        project_config[er][name]["es_display"] = copy.deepcopy(config["es_display"])
+
+
+def serialize_config(project_config: dict, er: str, name: str) -> str:
+    config = {}
+    for conf in CONFIG_PARTS:
+        if conf in project_config[er][name]:
+            config[conf] = project_config[er][name][conf]
+    return json.dumps(config, indent=4)
+
+
+def render_config(project_config: dict, er: str, name: str, config: dict) -> str:
+    # The display and es passes only read the lookups of other configs, so configs can
+    # be rendered independently of each other
+    if "relations_base" in project_config:
+        process_display(project_config, er, name, config)
+        process_es(project_config, er, name, config)
+    return serialize_config(project_config, er, name)
+
+
+# Project config of a worker process, set once when the worker starts
+_worker_project_config: typing.Optional[dict] = None
+
+
+def _init_worker(project_config: dict) -> None:
+    global _worker_project_config
+    _worker_project_config = project_config
+
+
+def _render_worker(er: str, name: str, config: dict) -> str:
+    return render_config(_worker_project_config, er, name, config)
+
+
+def render_configs(
+    project_config: dict,
+    config_files: typing.List[ConfigFile],
+    workers: int,
+) -> typing.Dict[str, str]:
+    if workers <= 1 or len(config_files) < POOL_MIN_CONFIGS:
+        return {
+            cf.key: render_config(project_config, cf.er, cf.name, cf.config)
+            for cf in config_files
+        }
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(project_config,),
+    ) as executor:
+        futures = {
+            cf.key: executor.submit(_render_worker, cf.er, cf.name, cf.config)
+            for cf in config_files
+        }
+        return {key: future.result() for (key, future) in futures.items()}
+
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_dependencies(project_config: dict, content: str) -> typing.List[str]:
+    # Configs of which the lookups can be used when replacing the paths in a config:
+    # every referenced relation and the entity types on both of its ends
+    dependencies = set()
+    for relation_name in RE_RELATION_REFERENCE.findall(content):
+        dependencies.add(f"relation/{relation_name}")
+        if relation_name in project_config.get("relations_base", {}):
+            relation_base = project_config["relations_base"][relation_name]
+            for entity_name in relation_base["domain"] + relation_base["range"]:
+                dependencies.add(f"entity/{entity_name}")
+    return sorted(dependencies)
+
+
+def read_manifest() -> typing.Dict:
+    if not os.path.exists(MANIFEST):
+        return {
+            "hashes": {},
+            "dependencies": {},
+        }
+    with open(MANIFEST) as f:
+        return ujson.load(f)
+
+
+def process(incremental: bool = False, workers: typing.Optional[int] = None) -> None:
+    # With incremental, only configs of which the human readable config changed or that
+    # depend on the lookup of a changed config are processed. Content hashes and
+    # dependencies are kept in a manifest in the config folder.
+    # With many configs to process, the display and es passes are run in a pool of
+    # worker processes (by default one per cpu). Only configs that differ from the file
+    # on disk are written.
+    if workers is None:
+        workers = os.cpu_count() or 1
+    project_config: typing.Dict[str, typing.Dict] = {
+        "entity": {},
+        "relation": {},
+    }
+    load_base_config(project_config)
+
+    manifest = read_manifest()
+    hashes: typing.Dict[str, str] = {}
+    for fn in BASE_FILES:
+        if os.path.exists(f"human_readable_config/{fn}"):
+            hashes[fn] = hash_file(f"human_readable_config/{fn}")
+    config_files = load_config_files()
+    for (key, config_file) in config_files.items():
+        hashes[key] = config_file.hash
+
+    # A change in the base configs can affect every config
+    full = (
+        not incremental
+        or "relations_base" not in project_config
+        or any(manifest["hashes"].get(fn) != hashes.get(fn) for fn in BASE_FILES)
+    )
+    changed = [
+        key
+        for key in config_files
+        if full
+        or manifest["hashes"].get(key) != hashes[key]
+        or config_files[key].output_text is None
+    ]
+    # Configs of which the lookup changed, deleted configs might have been used as well
+    lookup_changed = {
+        key for key in manifest["hashes"] if key not in hashes and key not in BASE_FILES
+    }
+
+    # first iteration for all changed configs: lookups are needed by other configs
+    for key in changed:
+        cf = config_files[key]
+        prev_lookup = cf.output_lookup
+        process_base(project_config, cf.er, cf.name, cf.config, prev_lookup)
+        if project_config[cf.er][cf.name].get("lookup") != prev_lookup:
+            lookup_changed.add(key)
+    for (key, cf) in config_files.items():
+        if key not in changed:
+            # Only the lookup of unchanged configs is needed
+            project_config[cf.er][cf.name] = {}
+            lookup = cf.output_lookup
+            if lookup is not None:
+                project_config[cf.er][cf.name]["lookup"] = lookup
+
+    dependencies = {
+        key: (
+            get_dependencies(project_config, cf.content)
+            if key in changed
+            else manifest["dependencies"].get(key, [])
+        )
+        for (key, cf) in config_files.items()
+    }
+    affected = set(changed)
+    for (key, cf) in config_files.items():
+        if key not in affected and lookup_changed.intersection(dependencies[key]):
+            affected.add(key)
+            process_base(project_config, cf.er, cf.name, cf.config, cf.output_lookup)
+
+    outputs = render_configs(
+        project_config,
+        [config_files[key] for key in sorted(affected)],
+        workers,
+    )
 
     # write out config
     for er in ["entity", "relation"]:
         if not os.path.exists(f"config/{er}"):
             os.makedirs(f"config/{er}")
-        for name in project_config[er]:
-            with open(f"config/{er}/{name}.json", "w") as f:
-                config = {}
-                for conf in [
-                    "detail",
-                    "source",
-                    "data",
-                    "display",
-                    "edit",
-                    "es_data",
-                    "es_display",
-                    "style",
-                ]:
-                    if conf in project_config[er][name]:
-                        config[conf] = project_config[er][name][conf]
-                json.dump(config, f, indent=4)
+    written = 0
+    for (key, output) in outputs.items():
+        if output == config_files[key].output_text:
+            continue
+        with open(f"config/{key}.json", "w") as f:
+            f.write(output)
+        written += 1
+    print(
+        f"Processed {len(affected)} of {len(config_files)} configs, {written} changed"
+    )
+
+    with open(MANIFEST, "w") as f:
+        json.dump(
+            {
+                "hashes": hashes,
+                "dependencies": dependencies,
+            },
+            f,
+            indent=4,
+        )
 
 
 if __name__ == "__main__":
-    process()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process configs that changed or depend on changed configs",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of worker processes (default: number of cpus)",
+    )
+    args = parser.parse_args()
+    process(args.incremental, args.workers)